@@ -0,0 +1,6 @@
+# asyncio entry point, e.g.
+#   hypercorn -b 0.0.0.0:$PORT -w 3 asgi:application
+from queue_app.async_server import app as application
+from quart_cors import cors
+
+application = cors(application, allow_origin="*")
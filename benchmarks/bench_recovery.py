@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Time for the queue engine to recover its state after a restart.
+
+    python benchmarks/bench_recovery.py [-n 100000] [--tail 10000]
+
+Fills an engine (with a persistence.Journal) with n queued players, writes
+a snapshot, makes --tail more journaled changes (declares, polls that start
+games, cancels), then times a fresh engine loading the snapshot, replaying
+the journal tail and rebuilding its queue, slots and timeouts. Also times
+writing the snapshot, which the engine does every snapshot_every records.
+
+For 100,000 entries and a 10,000-record tail: about 0.6 s to recover
+(0.16-0.19 s reading, the rest rebuilding), 0.4 s to write an 11.5 MB
+snapshot.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from queue_app import persistence
+from queue_app.queue_engine import QueueEngine
+
+
+def fill(engine, n, rng, t):
+    pids = []
+    for i in range(n):
+        pid = "%032x" % rng.getrandbits(128)
+        # spread over many addresses, or the per-IP cap refuses them
+        engine.declare(pid, 0, "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255), t)
+        pids.append(pid)
+    return pids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', type=int, default=100000)
+    parser.add_argument('--tail', type=int, default=10000,
+                        help="journal records made after the snapshot")
+    args = parser.parse_args()
+    rng = random.Random(1)
+    directory = tempfile.mkdtemp(prefix='queue_app_state_')
+    try:
+        journal = persistence.Journal(directory, snapshot_every=10**9)
+        journal.load()
+        engine = QueueEngine(journal=journal, max_per_ip=10**9)
+        t = time.time()
+        pids = fill(engine, args.n, rng, t)
+        journal.commit()
+        t0 = time.perf_counter()
+        journal.write_snapshot(engine.export_state())
+        print("snapshot of {:,} entries: {:.3f} s, {:.1f} MB".format(
+                  len(engine.entries), time.perf_counter() - t0,
+                  os.path.getsize(os.path.join(directory, persistence.SNAPSHOT))/1e6))
+        made = journal.seq
+        while journal.seq - made < args.tail:
+            x = rng.random()
+            if x < 0.4:
+                pids.extend(fill(engine, 1, rng, t))
+            elif x < 0.8:
+                engine.action(rng.choice(pids), 0, t)
+            else:
+                engine.cancel(rng.choice(pids), t)
+        journal.close()
+        # the restart
+        t0 = time.perf_counter()
+        journal = persistence.Journal(directory)
+        state, records = journal.load()
+        t1 = time.perf_counter()
+        restored = QueueEngine(journal=journal, max_per_ip=10**9)
+        restored.restore(state, records, time.time())
+        t2 = time.perf_counter()
+        print("recovery: {:.3f} s ({:.3f} s reading, {:.3f} s rebuilding; "
+              "{:,} entries, {:,} records replayed, {:,} queued)".format(
+                  t2 - t0, t1 - t0, t2 - t1, len(restored.entries),
+                  len(records), len(restored.queue)))
+        assert len(restored.queue) == len(engine.queue)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
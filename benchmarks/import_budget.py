@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Cold import time of the web tier, checked against a budget.
+
+    python benchmarks/import_budget.py [--budget 0.6] [--module queue_app.flask_server]
+        [--runs 5] [--top 15]
+
+Imports the module (which also runs setup_app) in fresh interpreters, from
+an empty working directory, and takes the best of --runs wall times. Prints
+the modules with the largest cumulative import times (python -X importtime)
+and exits with status 1 if the best time is over --budget sec (env var
+IMPORT_BUDGET). queue_app/test_import_budget.py runs the same check
+under pytest, so that the build fails on a startup regression. Compile
+the sources first (python -m compileall queue_app), as a deploy would, or
+the first run also pays for compiling.
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import contextmanager
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MODULE = 'queue_app.flask_server'
+BUDGET = float(os.environ.get('IMPORT_BUDGET', 0.6)) # sec
+
+_TIMED = ("import time; t0 = time.perf_counter(); import {}; "
+          "print(time.perf_counter() - t0)")
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def _env(workdir):
+    return dict(os.environ,
+                PYTHONPATH=os.pathsep.join(filter(None, [ROOT,
+                                               os.environ.get('PYTHONPATH')])),
+                RATELIMIT_STORAGE_URL='memory://',
+                METRICS_DIR=os.path.join(workdir, 'metrics'))
+
+
+@contextmanager
+def _workdir():
+    workdir = tempfile.mkdtemp(prefix='queue_app_import_')
+    # setup_app's loggers write to ./logs
+    os.makedirs(os.path.join(workdir, 'logs'))
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def import_seconds(module, workdir):
+    out = subprocess.run([sys.executable, '-c', _TIMED.format(module)],
+                         cwd=workdir, env=_env(workdir), check=True,
+                         stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return float(out.split()[-1])
+
+
+def top_imports(module, workdir, n):
+    """(cumulative usec, module) for the n slowest top-level imports made
+    by `module` itself.
+    """
+    err = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                          'import ' + module],
+                         cwd=workdir, env=_env(workdir), check=True,
+                         stderr=subprocess.PIPE, universal_newlines=True).stderr
+    rows = []
+    for line in err.splitlines():
+        m = _LINE.match(line)
+        # depth 1 (and the module itself) only, so nothing is counted twice
+        if m and (len(m.group(3)) <= 3 or m.group(4) == module):
+            rows.append((int(m.group(2)), m.group(4)))
+    return sorted(rows, reverse=True)[:n]
+
+
+def best_import_seconds(module=MODULE, runs=5):
+    """Best wall time of `runs` cold imports of `module`, in sec.
+    """
+    with _workdir() as workdir:
+        return min(import_seconds(module, workdir) for _ in range(runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--module', default=MODULE)
+    parser.add_argument('--budget', type=float, default=BUDGET, help="sec")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    best = best_import_seconds(args.module, args.runs)
+    with _workdir() as workdir:
+        for usec, name in top_imports(args.module, workdir, args.top):
+            print("{:10.1f} ms  {}".format(usec/1000.0, name))
+    print("import {}: best {:.3f} s of {} (budget {:.3f} s)".format(
+              args.module, best, args.runs, args.budget))
+    if best > args.budget:
+        print("over budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
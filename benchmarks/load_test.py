@@ -0,0 +1,513 @@
+#!/usr/bin/env python
+"""Load test for the web tier (queue_app.flask_server under gunicorn).
+
+    python benchmarks/load_test.py [--worker-classes sync,gthread,gevent]
+        [--workers 1,2,4] [--mix status_heavy] [--concurrency 32]
+        [--duration 10] [--backend-latency 2] [-o results.json]
+    python benchmarks/load_test.py --compare old.json new.json
+
+Needs no Redis server. A stand-in broker speaking just enough of the Redis
+protocol for pub/sub (SUBSCRIBE, PUBLISH, PING) runs on loopback in this
+process. By default it also answers commands on player-in/admin itself
+after --backend-latency ms, with canned replies shaped like the engine's.
+Use --engine to run the real queue engine against it instead, and
+--partitions N to split the backend into N partitions (N engines with
+--engine).
+
+For every worker class and worker count, gunicorn is started on a free
+port. Client processes then replay the chosen traffic mix for --duration
+sec, each simulating many players (keep-alive HTTP/1.1, one private id and
+X-Forwarded-For address per player, so the per-id rate limit and per-IP
+cap are not what gets measured). A player's first call joins the queue.
+Results are throughput plus p50/p95/p99 latency, overall and per
+endpoint. Every run is saved as JSON together with the git commit, so two
+result files can be compared with --compare.
+"""
+
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# endpoint: weight
+MIXES = {
+    # players in games polling and moving
+    'status_heavy': {'status': 70, 'move': 20, 'request_game': 5, 'cancel': 5},
+    # a rush of arrivals
+    'arrivals': {'request_game': 60, 'status': 30, 'cancel': 10},
+    'balanced': {'request_game': 25, 'status': 25, 'move': 25, 'cancel': 25},
+}
+
+
+# --- stand-in broker
+
+def _encode(value, kind=b'*'):
+    """RESP encoding; kind is b'>' for RESP3 pushes (pub/sub messages).
+    """
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, dict):
+        return b"%%%d\r\n" % len(value) + b"".join(
+                    _encode(k) + _encode(v) for k, v in value.items())
+    return kind + b"%d\r\n" % len(value) + b"".join(_encode(v) for v in value)
+
+
+def _stub_reply(content):
+    """Canned reply frame to a backend command, shaped like QueueEngine's.
+    """
+    cmd, args = next(iter(content.items()))
+    if cmd == 'declare':
+        reply = {"status": "queued", "public_id": "ABC", "position": 1,
+                 "private_id": args.get('private_id') or uuid.uuid4().hex}
+    elif cmd == 'action':
+        reply = {"status": "playing", "public_id": "ABC",
+                 "game": {"t": 1.0, "position": 0.0, "over": False}}
+    elif cmd == 'cancel':
+        reply = {"status": "cancelled"}
+    else:
+        reply = {"status": "ok"}
+    return content['_msg_id'].encode() + b" " + json.dumps(reply).encode()
+
+
+class StandInBroker(object):
+    """Loopback pub/sub server for redis-py clients, optionally answering
+    backend commands itself after `latency` (+ up to `jitter`) sec.
+    """
+    def __init__(self, latency=0.002, jitter=0.0, answer=True):
+        self.latency = latency
+        self.jitter = jitter
+        self.answer = answer
+        self.subscribers = {}
+        self.published = 0
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+        return self
+
+    def _serve(self):
+        asyncio.set_event_loop(self._loop)
+        server = self._loop.run_until_complete(asyncio.start_server(
+                    self._client, '127.0.0.1', 0))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2])
+        return args
+
+    async def _client(self, reader, writer):
+        channels = set()
+        # pub/sub frames are arrays in RESP2, pushes in RESP3
+        push = b'*'
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                cmd = args[0].upper()
+                if cmd == b'PUBLISH':
+                    writer.write(_encode(self.publish(args[1], args[2])))
+                elif cmd == b'SUBSCRIBE':
+                    for ch in args[1:]:
+                        channels.add(ch)
+                        self.subscribers.setdefault(ch, {})[writer] = push
+                        writer.write(_encode([b'subscribe', ch, len(channels)], push))
+                elif cmd == b'UNSUBSCRIBE':
+                    for ch in args[1:] or list(channels):
+                        channels.discard(ch)
+                        self.subscribers.get(ch, {}).pop(writer, None)
+                        writer.write(_encode([b'unsubscribe', ch, len(channels)], push))
+                elif cmd == b'PING':
+                    writer.write(b"+PONG\r\n" if not channels else
+                                 _encode([b'pong', b''], push))
+                elif cmd == b'HELLO':
+                    # redis-py >= 8 asks for RESP3 by default
+                    proto = int(args[1]) if len(args) > 1 else 2
+                    if proto == 3:
+                        push = b'>'
+                    writer.write(_encode({b'server': b'stand-in',
+                                          b'version': b'7.0.0',
+                                          b'proto': proto}))
+                else:
+                    # CLIENT SETINFO, SELECT, ... are all fine
+                    writer.write(b"+OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for ch in channels:
+                self.subscribers.get(ch, {}).pop(writer, None)
+            writer.close()
+
+    def publish(self, channel, data):
+        self.published += 1
+        subs = self.subscribers.get(channel, {})
+        for w, push in subs.items():
+            w.write(_encode([b'message', channel, data], push))
+        n = len(subs)
+        if self.answer and channel.split(b'.')[0] in (b'player-in', b'admin'):
+            content = json.loads(data)
+            delay = self.latency + random.random()*self.jitter
+            frames = {}
+            for cmd in content.get('batch', [content]):
+                frames.setdefault(cmd['client'], []).append(_stub_reply(cmd))
+            for client, replies in frames.items():
+                self._loop.call_later(delay, self.publish,
+                                      ("client-" + client).encode(),
+                                      b"\n".join(replies))
+            n += 1
+        return n
+
+
+# --- load generation
+
+def _client_proc(port, mix, n_threads, players, duration, seed, out_q):
+    endpoints = list(mix)
+    weights = list(itertools.accumulate(mix[e] for e in endpoints))
+    results = []
+    deadline = time.time() + duration
+
+    def worker(k):
+        r = random.Random(seed*1000 + k)
+        ids = [uuid.UUID(int=r.getrandbits(128)).hex for _ in range(players)]
+        # distinct addresses, or the engine's per-IP cap kicks in
+        headers = [{'X-Forwarded-For': '10.%d.%d.%d' % (seed % 256, k % 256, j % 256)}
+                   for j in range(players)]
+        joined = [False]*players
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        i = 0
+        while time.time() < deadline:
+            j = i % players
+            pid = ids[j]
+            i += 1
+            if joined[j]:
+                ep = endpoints[_pick(weights, r.random()*weights[-1])]
+            else:
+                # a player's first call puts them in the queue
+                ep = 'request_game'
+                joined[j] = True
+            if ep == 'request_game':
+                path = "/request_game/1/{0}?private_id={0}".format(pid)
+            elif ep == 'move':
+                path = "/move/{}?private_id={}".format(r.choice((-1, 1)), pid)
+            else:
+                path = "/{}?private_id={}".format(ep, pid)
+            t0 = time.perf_counter()
+            try:
+                conn.request('GET', path, headers=headers[j])
+                resp = conn.getresponse()
+                body = resp.read()
+                status = resp.status
+                if status == 200 and body.startswith(b'{"ERROR"'):
+                    status = 'error'
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                status = 'failed'
+            local.append((ep, status, time.perf_counter() - t0))
+        conn.close()
+        results.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out_q.put(results)
+
+
+def _pick(cumulative, x):
+    for i, c in enumerate(cumulative):
+        if x < c:
+            return i
+    return len(cumulative) - 1
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return {}
+    xs = sorted(latencies)
+    def p(q):
+        return round(xs[min(len(xs) - 1, int(q*len(xs)))]*1000, 3)
+    return {'p50': p(0.5), 'p95': p(0.95), 'p99': p(0.99),
+            'max': round(xs[-1]*1000, 3),
+            'mean': round(sum(xs)/len(xs)*1000, 3)}
+
+
+def summarize(samples, duration):
+    ok = [s for s in samples if s[1] == 200]
+    out = {'requests': len(samples),
+           'ok': len(ok),
+           'rate_limited': sum(1 for s in samples if s[1] == 429),
+           'shed': sum(1 for s in samples if s[1] == 503),
+           'errors': sum(1 for s in samples if s[1] not in (200, 429, 503)),
+           'throughput_rps': round(len(ok)/duration, 1),
+           'latency_ms': _percentiles([s[2] for s in ok]),
+           'per_endpoint': {}}
+    for ep in sorted(set(s[0] for s in samples)):
+        lat = [s[2] for s in ok if s[0] == ep]
+        out['per_endpoint'][ep] = dict(requests=len(lat),
+                                       latency_ms=_percentiles(lat))
+    return out
+
+
+def drive(port, mix, concurrency, procs, players, duration):
+    procs = max(1, min(procs, concurrency))
+    q = multiprocessing.Queue()
+    ps = []
+    for i in range(procs):
+        n = concurrency // procs + (1 if i < concurrency % procs else 0)
+        p = multiprocessing.Process(target=_client_proc,
+                args=(port, MIXES[mix], n, players, duration, i + 1, q))
+        p.start()
+        ps.append(p)
+    samples = []
+    for _ in ps:
+        samples.extend(q.get())
+    for p in ps:
+        p.join()
+    return summarize(samples, duration)
+
+
+# --- server under test
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for_port(port, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited with code %s" % proc.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening on %d" % port)
+
+
+def start_gunicorn(worker_class, workers, threads, env, workdir, preload=False):
+    port = _free_port()
+    # the repo's settings, overridden here
+    cmd = [sys.executable, '-m', 'gunicorn',
+           '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '-k', worker_class,
+           '-w', str(workers), '-b', '127.0.0.1:%d' % port,
+           '--threads', str(threads if worker_class == 'gthread' else 1),
+           '--chdir', workdir, '--log-level', 'warning',
+           'queue_app.flask_server:app']
+    if worker_class == 'gevent':
+        cmd[5:5] = ['--worker-connections', '1000']
+    env = dict(env, WORKER_CLASS=worker_class, PRELOAD_APP='1' if preload else '0')
+    proc = subprocess.Popen(cmd, env=env)
+    try:
+        _wait_for_port(port, proc)
+    except Exception:
+        proc.kill()
+        raise
+    return proc, port
+
+
+def _worker_class_available(name):
+    if name == 'gevent':
+        try:
+            import gevent
+        except ImportError:
+            return False
+    return True
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(args):
+    broker = StandInBroker(args.backend_latency/1000.0,
+                           args.backend_jitter/1000.0,
+                           answer=not args.engine).start()
+    workdir = tempfile.mkdtemp(prefix='queue_app_load_')
+    os.makedirs(os.path.join(workdir, 'logs'))
+    env = dict(os.environ,
+               REDIS_URL='redis://127.0.0.1:%d' % broker.port,
+               RATELIMIT_STORAGE_URL='mmap://' + os.path.join(workdir, 'ratelimit.bin'),
+               METRICS_DIR=os.path.join(workdir, 'metrics'),
+               PUBLISH_BATCH_WINDOW=str(args.batch_window/1000.0)
+                                    if args.batch_window else '',
+               PARTITIONS=str(args.partitions or ''),
+               ADMISSION_TARGET=str(args.admission_target/1000.0)
+                                if args.admission_target is not None
+                                else os.environ.get('ADMISSION_TARGET', ''),
+               PYTHONPATH=os.pathsep.join(filter(None, [ROOT,
+                                            os.environ.get('PYTHONPATH')])))
+    engines = []
+    if args.engine:
+        cmd = [sys.executable, '-m', 'queue_app.queue_engine',
+               '--redis-url', env['REDIS_URL']]
+        if args.partitions:
+            for i in range(args.partitions):
+                engines.append(subprocess.Popen(cmd + ['--partition', str(i)],
+                                                env=env, cwd=workdir))
+        else:
+            engines.append(subprocess.Popen(cmd, env=env, cwd=workdir))
+    report = {'commit': _git_commit(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'host': platform.node(),
+              'cpus': os.cpu_count(),
+              'config': {k: v for k, v in vars(args).items()
+                         if k not in ('compare', 'output')},
+              'runs': []}
+    try:
+        for worker_class in args.worker_classes.split(','):
+            if not _worker_class_available(worker_class):
+                print("skipping %s: not installed" % worker_class)
+                continue
+            for workers in [int(w) for w in args.workers.split(',')]:
+                proc, port = start_gunicorn(worker_class, workers, args.threads,
+                                            env, workdir, args.preload)
+                try:
+                    drive(port, args.mix, args.concurrency, args.client_procs,
+                          args.players, args.warmup)
+                    result = drive(port, args.mix, args.concurrency,
+                                   args.client_procs, args.players, args.duration)
+                finally:
+                    proc.terminate()
+                    proc.wait()
+                result.update(worker_class=worker_class, workers=workers,
+                              threads=args.threads if worker_class == 'gthread' else 1,
+                              mix=args.mix, concurrency=args.concurrency,
+                              duration=args.duration)
+                report['runs'].append(result)
+                lat = result['latency_ms']
+                print("{:8} w={:<2} {:>8.1f} req/s  p50={} p95={} p99={} ms  "
+                      "errors={} 429s={} 503s={}".format(worker_class, workers,
+                        result['throughput_rps'], lat.get('p50'), lat.get('p95'),
+                        lat.get('p99'), result['errors'], result['rate_limited'],
+                        result['shed']))
+    finally:
+        for engine in engines:
+            engine.terminate()
+            engine.wait()
+        broker.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("results written to %s" % args.output)
+
+
+def compare(old_path, new_path):
+    """Print throughput and p99 changes for runs present in both files.
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    key = lambda r: (r['worker_class'], r['workers'], r['threads'], r['mix'],
+                     r['concurrency'])
+    old_runs = {key(r): r for r in old['runs']}
+    print("{} -> {}".format((old.get('commit') or '?')[:10],
+                            (new.get('commit') or '?')[:10]))
+    for r in new['runs']:
+        o = old_runs.get(key(r))
+        if o is None:
+            continue
+        def change(a, b):
+            return "{:+.1f}%".format(100.0*(b - a)/a) if a else "n/a"
+        print("{:8} w={:<2} {:12} req/s {:>9.1f} -> {:<9.1f} ({})  "
+              "p99 {} -> {} ms ({})".format(r['worker_class'], r['workers'],
+                r['mix'], o['throughput_rps'], r['throughput_rps'],
+                change(o['throughput_rps'], r['throughput_rps']),
+                o['latency_ms'].get('p99'), r['latency_ms'].get('p99'),
+                change(o['latency_ms'].get('p99', 0), r['latency_ms'].get('p99', 0))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--worker-classes', default='sync,gthread,gevent')
+    parser.add_argument('--workers', default='1,2,4',
+                        help="comma-separated worker counts")
+    parser.add_argument('--threads', type=int, default=8,
+                        help="threads per gthread worker")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='status_heavy')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help="simultaneous client connections")
+    parser.add_argument('--client-procs', type=int,
+                        default=max(1, (os.cpu_count() or 2)//2))
+    parser.add_argument('--players', type=int, default=200,
+                        help="private ids per client connection")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--backend-latency', type=float, default=2.0,
+                        help="ms before the stand-in backend replies")
+    parser.add_argument('--backend-jitter', type=float, default=0.0,
+                        help="extra ms of uniform random delay")
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help="ms to coalesce commands per worker (0: off)")
+    parser.add_argument('--engine', action='store_true',
+                        help="answer with the real queue engine")
+    parser.add_argument('--preload', action='store_true',
+                        help="fork the workers from a preloaded app")
+    parser.add_argument('--admission-target', type=float, default=None,
+                        help="ms of backend latency above which workers cut "
+                             "their in-flight limit (0: no limit)")
+    parser.add_argument('--partitions', type=int, default=0,
+                        help="number of backend partitions (0: one channel)")
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.output is None:
+        args.output = "load_{}_{}.json".format((_git_commit() or 'nogit')[:10],
+                                               time.strftime('%Y%m%d-%H%M%S'))
+    run_all(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+"""gunicorn settings for the web tier (read from the working directory):
+
+    gunicorn queue_app.flask_server:app
+
+With preload_app (the default here, PRELOAD_APP=0 to turn it off) the app
+is imported once in the master and the workers are forked from it, so a
+new or recycled worker starts serving at once and shares the master's
+memory copy-on-write. Per-process state (reply listener, instance ID,
+metrics writer, batch publisher, log writer thread) is created in each
+worker on first use. The gevent worker class patches the standard library
+only after the fork, so preloading is skipped for it.
+"""
+
+import gc
+import os
+
+bind = "0.0.0.0:" + os.environ.get('PORT', '5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 3))
+worker_class = os.environ.get('WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('THREADS', 8))
+preload_app = os.environ.get('PRELOAD_APP', '1') != '0' and \
+              worker_class != 'gevent'
+accesslog = None
+errorlog = '-'
+
+
+def on_starting(server):
+    # counters start again with the server (see metrics.py)
+    from queue_app.metrics import metrics
+    metrics.clear()
+
+
+def pre_fork(server, worker):
+    # move everything allocated so far out of the collector's reach, so
+    # that collections in the workers do not touch (and copy) those pages
+    gc.freeze()
@@ -0,0 +1,70 @@
+"""Adaptive limit on the backend calls that one web worker has in flight,
+so that a slow backend gets turned-away requests instead of every worker
+thread (or connection) waiting out REPLY_TIMEOUT.
+
+The limit follows AIMD on the measured round trip, as TCP's congestion
+window does: each reply within `target` sec adds about 1 to the limit per
+limit's worth of replies (while the calls in flight use at least half of
+it), and a slower reply or a timeout sets it to `backoff` times the calls
+that were in flight, at most once per round trip: only calls started
+after the last decrease can cause another. Cutting from the calls in
+flight rather than from the limit brings the limit under what the worker
+is actually running at once, even when it has fewer threads than the
+limit. A call made when the limit is reached is refused at once; the
+server answers 503 with a Retry-After of about one round trip.
+
+Only do_messaging is limited, so pages that do not wait on the backend
+(/, /dashboard, /metrics) are never turned away.
+"""
+
+import threading
+import time
+
+
+class ConcurrencyLimiter(object):
+    def __init__(self, target, initial=20, min_limit=1, max_limit=1000,
+                 backoff=0.5, smoothing=0.1):
+        self.target = target
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.in_flight = 0
+        # moving average of the round trip, for Retry-After
+        self.latency = 0.0
+        self._decreased_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Start time of a call that may go ahead (pass it to release), or
+        None if the limit is reached.
+        """
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return None
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, start, replied=True):
+        """End a call that acquire() let through; replied=False for a
+        timeout or error.
+        """
+        now = time.monotonic()
+        rtt = now - start
+        with self._lock:
+            in_flight = self.in_flight
+            self.in_flight -= 1
+            self.latency += self.smoothing*(rtt - self.latency)
+            if not replied or rtt > self.target:
+                if start >= self._decreased_at:
+                    self.limit = max(self.min_limit,
+                                     min(self.limit, in_flight)*self.backoff)
+                    self._decreased_at = now
+            elif in_flight*2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1/self.limit)
+
+    def retry_after(self):
+        """Sec a refused client should wait before trying again.
+        """
+        return max(self.latency, self.target)
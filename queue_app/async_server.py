@@ -0,0 +1,359 @@
+"""asyncio variant of the queue management server (see asgi.py).
+
+Serves the same routes and JSON/JSONP responses as flask_server, but each
+request awaits its backend reply instead of holding a worker, so one process
+can keep thousands of waiting clients open. Requires Python 3.7+, quart and
+redis-py >= 4.2 (for redis.asyncio).
+"""
+
+from quart import Quart, request, render_template, Response, has_request_context
+import os
+import json
+import uuid
+import asyncio
+from functools import wraps
+import redis.asyncio as aioredis
+from queue_app import utils
+from queue_app import jsoncodec
+from queue_app import web
+from queue_app.metrics import metrics
+from queue_app.messaging import AsyncReplyDispatcher, AsyncBatchPublisher
+from queue_app.logger import log
+from queue_app import common as common
+
+app = Quart("Queue management server")
+
+# ------------------------------------------------------------------
+
+# same key, budget and storage as the limiter in flask_server
+limiter = web.new_limiter()
+
+def get_remote_address():
+    return web.remote_address(request.headers.get('X-Forwarded-For'),
+                              request.remote_addr)
+
+def get_id():
+    return request.args.get('private_id', default=None, type=str)
+
+def get_identity():
+    return web.identity(get_id(), request.path, get_remote_address())
+
+@app.before_request
+async def check_rate_limit():
+    if limiter.remote:
+        # a network round trip, keep it off the event loop
+        loop = asyncio.get_event_loop()
+        allowed, wait = await loop.run_in_executor(None, limiter.hit,
+                                                   get_identity())
+    else:
+        allowed, wait = limiter.hit(get_identity())
+    if not allowed:
+        return Response(*web.rate_limited(wait))
+
+# ==================
+
+
+def get_IP(as_str=False):
+    try:
+        ip_addr = str(request.headers['X-Forwarded-For'])
+    except KeyError:
+        ip_addr = str(request.remote_addr)
+    if as_str:
+        return ip_addr
+    else:
+        return ip_addr.encode('utf-8')
+
+
+def json_response(body):
+    """Response for a JSON body (see web.json_body); a Response is passed
+    through.
+    """
+    if isinstance(body, Response):
+        return body
+    body, mimetype = web.json_body(body, request.args.get('callback',
+                                                          default=None))
+    return Response(body, mimetype=mimetype)
+
+
+def jsonify(data):
+    return json_response(jsoncodec.dumps(data))
+
+
+def returns_json(f):
+    """Also assumes that private_id is a first argument for the endpoints.
+    """
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        try:
+            private_id = kwargs.pop('private_id')
+        except KeyError:
+            # must then be provided as a parameter
+            private_id = request.args.get('private_id', default=None)
+        if private_id is not None and not utils.is_private_id(private_id):
+            return jsonify({"ERROR": "Invalid private id"})
+        else:
+            try:
+                return json_response(await f(private_id, *args, **kwargs))
+            except Exception as err:
+                return jsonify({"ERROR": str(err)})
+    return decorated_function
+
+def is_admin():
+    return request.args.get('admin_code', default=0, type=int) \
+              == common.ADMIN_CODE
+
+def admin_only(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if is_admin():
+            try:
+                return json_response(await f(*args, **kwargs))
+            except Exception as err:
+                return jsonify({"ERROR": str(err)})
+        else:
+            return ''
+    return decorated_function
+
+
+async def do_messaging(content, is_admin=False, timeout=None):
+    """Publish a command to the backend and await its reply for at most
+    `timeout` seconds (default common.REPLY_TIMEOUT). Returns the reply's
+    JSON body as bytes (a dict for a command that went to every partition,
+    see web.BackendCall), None on timeout, or a 503 Response if this
+    process has too many calls in flight already (see admission.py).
+    """
+    if timeout is None:
+        timeout = common.REPLY_TIMEOUT
+    call = web.BackendCall(content, is_admin, app._admission, app._router)
+    if not call.admit():
+        return Response(*web.overloaded(call.limit))
+    try:
+        dispatcher = app._dispatcher
+        messages = call.prepare(app._this_instance, dispatcher.expect,
+                    request.endpoint if has_request_context() else None)
+        try:
+            for msg_id, channel, payload in messages:
+                if app._publisher is not None:
+                    app._publisher.publish(channel, payload)
+                else:
+                    await app._rq.publish(channel, payload)
+        except Exception:
+            for msg_id, channel, payload in messages:
+                dispatcher.cancel(msg_id)
+            raise
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        replies = []
+        for msg_id, channel, payload in messages:
+            try:
+                replies.append(await dispatcher.wait(msg_id,
+                                                max(0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                replies.append(None)
+        data = call.replied(replies)
+    finally:
+        call.release()
+    return data
+
+# ================================================
+
+@app.route('/log_tail')
+@admin_only
+async def admin_log_tail():
+    # this worker's latest log lines; poll again with the returned position
+    # to get only the lines added since
+    since = request.args.get('since', default=0, type=int)
+    lines, position = log.recent.read_since(since)
+    return {"position": position, "lines": lines}
+
+@app.route('/flush_pubsub')
+@admin_only
+async def admin_flush():
+    count = app._dispatcher.flush()
+    return json.dumps({"States flushed": str(count)})
+
+@app.route('/metrics')
+async def admin_metrics():
+    # plain text rather than JSON, so not @admin_only
+    if not is_admin():
+        return ''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/dump')
+@admin_only
+async def admin_dump():
+    content = {"dump": {}}
+    return await do_messaging(content, is_admin=True)
+
+@app.route('/game/<private_id>/<game_id>')
+@admin_only
+async def admin_game(private_id, game_id):
+    content = {"game": {"private_id": private_id,
+                        "game_id": game_id}}
+    return await do_messaging(content, is_admin=True)
+
+@app.route('/')
+async def main(*args, **kwargs):
+    return await render_template('index.html')
+
+@app.route('/dashboard')
+async def dashboard(*args, **kwargs):
+    return await render_template('dashboard.html')
+
+@app.route('/stats_totals')
+async def stats_tots(*args, **kwargs):
+    # the DB driver is blocking, so keep a cache miss off the event loop
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, web.stats_totals_text)
+
+# is the server up?
+@app.route("/wakeupserver")
+async def game_wakeupserver():
+    content = {"wakeup": {"dummy": None}}
+    try:
+        return json_response(await do_messaging(content))
+    except Exception as err:
+        return jsonify({"ERROR": str(err)})
+
+@app.route("/register_name/<private_id>/<public_id>/<name>")
+@app.route("/register_name/<private_id>/<public_id>", defaults={"name": None})
+@app.route("/register_name/<private_id>", defaults={"name": None,
+                                                    "public_id": None})
+@app.route("/register_name", defaults={"name": None,
+                                                    "public_id": None,
+                                                    "private_id": None})
+async def game_register_name(private_id, public_id, name):
+    if private_id is None or public_id is None or name is None:
+        return jsonify({"Error": "Invalid values for call parameters"})
+    content = {"register_name": {"private_id": private_id,
+                        "public_id": public_id,
+                        "name": name}}
+    try:
+        return json_response(await do_messaging(content))
+    except Exception as err:
+        return jsonify({"ERROR": str(err)})
+
+
+@app.route("/status")
+@returns_json
+async def game_status(private_id):
+    content = {"action": {"private_id": private_id,
+                          "move_dx": 0}}
+    return await do_messaging(content)
+
+async def status_events(private_id):
+    """Server-sent events for /status/stream (see flask_server).
+    """
+    dispatcher = app._dispatcher
+    updates = dispatcher.watch(private_id)
+    loop = asyncio.get_event_loop()
+    try:
+        yield web.SSE_START
+        first = True
+        renew_at = 0
+        while True:
+            if loop.time() >= renew_at:
+                body = await do_messaging({"watch": {"private_id": private_id}})
+                renew_at = loop.time() + common.STREAM_RENEW
+                if not web.renewal_is_event(body, first):
+                    yield web.SSE_KEEP_ALIVE
+                    continue
+                first = False
+            else:
+                try:
+                    body = await asyncio.wait_for(updates.get(),
+                                                  renew_at - loop.time())
+                except asyncio.TimeoutError:
+                    continue
+            yield web.sse_event(body)
+            if web.ends_stream(body):
+                return
+    finally:
+        dispatcher.unwatch(private_id, updates)
+
+@app.route("/status/stream")
+async def game_status_stream():
+    """Pushes the player's status as server-sent events whenever their
+    state or queue position changes, instead of /status being polled.
+    """
+    private_id = request.args.get('private_id', default=None)
+    if not utils.is_private_id(private_id):
+        return jsonify({"ERROR": "Invalid private id"})
+    response = Response(status_events(private_id), mimetype='text/event-stream',
+                        headers=web.SSE_HEADERS)
+    # the stream is open for as long as the player wants it
+    response.timeout = None
+    return response
+
+@app.route("/cancel")
+@returns_json
+async def game_cancel(private_id):
+    content = {"cancel": {"private_id": private_id}}
+    return await do_messaging(content)
+
+@app.route('/move/<distance>')
+@app.route('/move', defaults={"distance": None})
+@returns_json
+async def game_move(private_id, distance):
+    if distance is None:
+        return json.dumps({"Error": "Invalid distance parameter"})
+    content = {"action": {"private_id": private_id,
+                          "move_dx": float(distance)}}
+    return await do_messaging(content)
+
+@app.route('/request_game/<int:level>/<private_id>')
+@app.route('/request_game/<int:level>', defaults={"private_id": None})
+@app.route('/request_game', defaults={"private_id": None, "level": None})
+@returns_json
+async def game_request_game(private_id, level):
+    if level is None:
+        raise ValueError("Difficulty level must be provided")
+    content = {"declare": {"private_id": private_id,
+                           "level": int(level),
+                           "IPaddress": get_IP(as_str=True)}}
+    return await do_messaging(content)
+
+# ==========
+
+@app.errorhandler(404)
+async def page_not_found(e, *args, **kwargs):
+    return jsonify({"help": "TBD"})
+
+@app.before_serving
+async def start_messaging():
+    # one connection and reply listener per serving process
+    app._this_instance = uuid.uuid4().hex
+    app._rq = aioredis.from_url(os.environ.get('REDIS_URL',
+                                               'redis://localhost:6379'))
+    app._dispatcher = await AsyncReplyDispatcher(app._rq,
+                                "client-"+app._this_instance).start()
+    app._router = web.new_router()
+    window = web.publish_batch_window()
+    if window:
+        app._publisher = AsyncBatchPublisher(app._rq, window,
+                                             common.PUBLISH_MAX_BATCH)
+    else:
+        app._publisher = None
+    app._admission = web.new_admission_limit()
+
+@app.after_serving
+async def stop_messaging():
+    await app._dispatcher.stop()
+    await app._rq.close()
+
+# For ASGI init
+def setup_app(app):
+    log.make_log(app)
+    log.info("Starting up asyncio instance of app")
+    settings = 'dev_settings' #'production_settings'
+    log.info("Using " + settings)
+    app.config.from_object(settings)
+
+setup_app(app)
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    # counters start again with the server (see metrics.py)
+    metrics.clear()
+    app.run(host="0.0.0.0", port=port)
+    # web: hypercorn -b 0.0.0.0:$PORT -w 3 asgi:application
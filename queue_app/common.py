@@ -14,3 +14,39 @@ SEED_SIZE = 999999999
 
 ALLOW_SAME_IP = True
 CALLS_PER_SECOND = 3
+REPLY_TIMEOUT = 3 # sec, how long a web request waits for the backend
+ADMIN_CODE = 9134999136054730161
+ENGINE_INBOX_SIZE = 100000 # messages buffered by the queue engine
+STATS_CACHE_TTL = 5 # sec that /stats_totals may be stale
+# memory://, mmap:///path (shared by workers on a host) or redis://...
+# (shared by all hosts); overridden by env var RATELIMIT_STORAGE_URL
+RATELIMIT_STORAGE_URL = "mmap:///tmp/queue_app_ratelimit.bin"
+# write logs from a background thread (or set env var ASYNC_LOGGING=1)
+ASYNC_LOGGING = False
+# fraction of per-request INFO lines kept, by endpoint
+LOG_SAMPLE_RATES = {'game_status': 0.01, 'game_move': 0.01}
+# per-process metrics snapshots, summed by the /metrics endpoint
+METRICS_DIR = "/tmp/queue_app_metrics"
+# coalesce each worker's backend commands over this many sec (e.g. 0.002)
+# into one message; None publishes each at once. Env var PUBLISH_BATCH_WINDOW
+PUBLISH_BATCH_WINDOW = None
+PUBLISH_MAX_BATCH = 64
+# engine partition names, comma separated, or their number (see
+# partitioning.py); None means the single player-in channel. Env var PARTITIONS
+PARTITIONS = None
+# sec between a /status/stream connection's renewals of its watch; each one
+# also counts as a status poll, so keep it under PENDING_TIMEOUT
+STREAM_RENEW = 5
+# latest log lines (INFO and up) each process keeps for /log_tail
+LOG_TAIL_SIZE = 1000
+# where the queue engine records the public ids it has issued (one file per
+# engine/partition), or None to start from 1 on every run. Env var ID_FILE
+ID_FILE = None
+# directory for the queue engine's journal and snapshots (one per engine or
+# partition), or None to start empty on every run. Env var STATE_DIR
+STATE_DIR = None
+# each web worker limits its backend calls in flight (see admission.py),
+# backing off when replies take longer than this many sec, and answers 503
+# over the limit. Env var ADMISSION_TARGET; 0 turns the limit off
+ADMISSION_TARGET = 0.5
+ADMISSION_MAX_LIMIT = 1000
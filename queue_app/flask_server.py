@@ -1,11 +1,9 @@
-from flask import (Flask, request, render_template, render_template_string,
-     redirect, url_for, flash, session)
+from flask import (Flask, request, render_template,
+     redirect, url_for, flash, session, Response, has_request_context)
 from flask_bootstrap import Bootstrap
 import os
 # support cross-domain browser interfaces avoiding AJAX limitations
 from flask_jsonpify import jsonify
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 import datetime
 from time import sleep, time
 import json
@@ -13,7 +11,13 @@ import json
 from functools import wraps
 from copy import copy
 from queue_app import utils
+from queue_app import web
+from queue_app.metrics import metrics
+from queue_app.messaging import ReplyDispatcher, ReplyTimeout, BatchPublisher
 import uuid
+import queue
+import threading
+import redis
 from queue_app.logger import log
 from queue_app import common as common
 
@@ -22,33 +26,25 @@ Bootstrap(app)
 
 # ------------------------------------------------------------------
 
-# used by Limiter
+def get_remote_address():
+    return web.remote_address(request.headers.get('X-Forwarded-For'),
+                              request.remote_addr)
+
+# used by rate limiter
 def get_id():
-    return request.args.get('private_id', default="None", type=str)
+    return request.args.get('private_id', default=None, type=str)
 
 def get_identity():
-    private_id = get_id()
-    if private_id is None:
-        # try from path
-        private_id = request.path.split('/')[0]
-        if private_id == '':
-            # no id, so just use IP address
-            return get_remote_address()
-        elif len(private_id) == 32:
-            # is it really an ID? There are no other 32-char endpoints
-            # so this is good enough
-            return private_id
-        else:
-            # not a command
-            return get_remote_address()
-    else:
-        return private_id
+    return web.identity(get_id(), request.path, get_remote_address())
+
+# one budget per identity shared by all workers (see ratelimit.py)
+limiter = web.new_limiter()
 
-limiter = Limiter(
-    app,
-    key_func=get_identity,
-    default_limits=["{} per second".format(common.CALLS_PER_SECOND)]
-)
+@app.before_request
+def check_rate_limit():
+    allowed, wait = limiter.hit(get_identity())
+    if not allowed:
+        return Response(*web.rate_limited(wait))
 
 # ==================
 
@@ -65,6 +61,17 @@ def get_IP(as_str=False):
         return ip_addr.encode('utf-8')
 
 
+def json_response(body):
+    """Response for a JSON body (see web.json_body); a Response is passed
+    through.
+    """
+    if isinstance(body, Response):
+        return body
+    body, mimetype = web.json_body(body, request.args.get('callback',
+                                                          default=None))
+    return Response(body, mimetype=mimetype)
+
+
 def returns_json(f):
     """Also assumes that private_id is a first argument for the endpoints.
     """
@@ -80,27 +87,28 @@ def returns_json(f):
             # must then be provided as a parameter
             private_id = request.args.get('private_id', default=None)
             #log.info("pID from parameter: {}".format(private_id))
-        if private_id is not None and len(private_id) != 32:
+        if private_id is not None and not utils.is_private_id(private_id):
             return jsonify({"ERROR": "Invalid private id"})
         else:
             try:
-                return jsonify(json.loads(f(private_id, *args, **kwargs)))
+                return json_response(f(private_id, *args, **kwargs))
             except Exception as err:
                 #raise
                 return jsonify({"ERROR": str(err)})
     return decorated_function
 
+def is_admin():
+    return request.args.get('admin_code', default=0, type=int) \
+              == common.ADMIN_CODE
+
 def admin_only(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        is_admin = request.args.get('admin_code', default=0, type=int) \
-              == 9134999136054730161
-        if is_admin:
+        if is_admin():
             try:
-                data = json.loads(f(*args, **kwargs))
+                return json_response(f(*args, **kwargs))
             except Exception as err:
-                data = {"ERROR": str(err)}
-            return jsonify(data)
+                return jsonify({"ERROR": str(err)})
         else:
             return ''
     return decorated_function
@@ -134,44 +142,65 @@ def no_http(f):
             return http
     return decorated_function
 
-def do_messaging(content, is_admin=False):
-    content['client'] = app._this_instance
-    content['_call_time'] = t0 = time()
-    log.info("do_messaging content = " + str(content))
-    if is_admin:
-        channel = 'admin'
-    else:
-        channel = 'player-in'
-#     log.info("*************")
-#     for k, v in content.items():
-#         log.info("Key: {} {}".format(k, type(k)))
-#         log.info("Val: {} {}".format(v, type(v)))
-    app._rq.publish(channel, json.dumps(content))
-    t_wait = 0
-    while t_wait < 3:
-        # wait for response
-        state = app._p.get_message("client-"+app._this_instance)
-        if state is not None:
-            data = json.loads(state['data'])
-            if data['_call_time'] == content['_call_time']:
-                del data['_call_time']
-                #pass
-                log.info("Returning a value from client {}: {}".format(app._this_instance, data))
-                return json.dumps(data)
-            else:
-                #data['_timestamp_mismatch'] = True
-                # TEMP try pulling again, assuming duplicate
-                log.error("Duplicate message from client {}: {}".format(app._this_instance, state['data']))
-                continue
-            # TEMP: delete this _call_time check when confident
-            # about message loss / duplication
-            #state['data'] = json.dumps(data)
-            # state['data'] is a JSON string
-            #log.info("Returning a value {}".format(data))
-            #return json.dumps(data) #state['data']
-        else:
-            t_wait = time()-t0
-    log.error("Waited too long for response: t={}".format(t0))
+def get_dispatcher():
+    """One reply listener per worker process, created on first use so that
+    it is never inherited across a fork. Each process also gets its own
+    instance ID, and so reply channel, even when the workers were forked
+    from an app imported once in the master (gunicorn preload_app).
+    """
+    dispatcher = getattr(app, '_dispatcher', None)
+    if dispatcher is None or app._dispatcher_pid != os.getpid():
+        with _dispatcher_lock:
+            dispatcher = getattr(app, '_dispatcher', None)
+            if dispatcher is None or app._dispatcher_pid != os.getpid():
+                app._this_instance = uuid.uuid4().hex
+                dispatcher = ReplyDispatcher(app._rq,
+                                    "client-"+app._this_instance).start()
+                app._dispatcher = dispatcher
+                app._dispatcher_pid = os.getpid()
+    return dispatcher
+
+_dispatcher_lock = threading.Lock()
+
+def do_messaging(content, is_admin=False, timeout=None):
+    """Publish a command to the backend and block (without spinning) until
+    its reply arrives or `timeout` seconds pass (default
+    common.REPLY_TIMEOUT). Returns the reply's JSON body as bytes (a
+    dict for a command that went to every partition, see web.BackendCall),
+    None on timeout, or a 503 Response if this worker has too many calls
+    in flight already (see admission.py).
+    """
+    if timeout is None:
+        timeout = common.REPLY_TIMEOUT
+    call = web.BackendCall(content, is_admin, app._admission, app._router)
+    if not call.admit():
+        return Response(*web.overloaded(call.limit))
+    try:
+        dispatcher = get_dispatcher()
+        messages = call.prepare(app._this_instance, dispatcher.expect,
+                    request.endpoint if has_request_context() else None)
+        try:
+            for msg_id, channel, payload in messages:
+                if app._publisher is not None:
+                    app._publisher.publish(channel, payload)
+                else:
+                    app._rq.publish(channel, payload)
+        except Exception:
+            for msg_id, channel, payload in messages:
+                dispatcher.cancel(msg_id)
+            raise
+        deadline = time() + timeout
+        replies = []
+        for msg_id, channel, payload in messages:
+            try:
+                replies.append(dispatcher.wait(msg_id,
+                                                max(0, deadline - time())))
+            except ReplyTimeout:
+                replies.append(None)
+        data = call.replied(replies)
+    finally:
+        call.release()
+    return data
 
 # ================================================
 
@@ -196,20 +225,30 @@ def do_messaging(content, is_admin=False):
 #         pass
 #     return redirect(url_for('main'))
 
+@app.route('/log_tail')
+@admin_only
+def admin_log_tail():
+    # this worker's latest log lines; poll again with the returned position
+    # to get only the lines added since
+    since = request.args.get('since', default=0, type=int)
+    lines, position = log.recent.read_since(since)
+    return {"position": position, "lines": lines}
+
 @app.route('/flush_pubsub')
 @admin_only
 def admin_flush():
-    tries = 10  # when None
-    count = 0
-    while tries >= 0:
-        state = app._p.get_message("client-"+app._this_instance)
-        if state is None:
-            tries -= 1
-        else:
-            count += 1
-        sleep(0.1)
+    # stale replies are discarded by the dispatcher as they arrive, so
+    # just report how many there were
+    count = get_dispatcher().flush()
     return json.dumps({"States flushed": str(count)})
 
+@app.route('/metrics')
+def admin_metrics():
+    # plain text rather than JSON, so not @admin_only
+    if not is_admin():
+        return ''
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/dump')
 @admin_only
 def admin_dump():
@@ -244,9 +283,7 @@ def dashboard(*args, **kwargs):
 
 @app.route('/stats_totals')
 def stats_tots(*args, **kwargs):
-    num_events = utils.read_sql("SELECT COUNT(*) FROM game_event_log;")[0][0]
-    num_games = utils.read_sql("SELECT COUNT(game_id) FROM game_summary;")[0][0]
-    return render_template_string("There have been {} games played so far, with a total of {} API calls.".format(num_games, num_events))
+    return web.stats_totals_text()
 
 # is the server up?
 @app.route("/wakeupserver")
@@ -259,7 +296,7 @@ def game_wakeupserver():
     #else:
     content = {"wakeup": {"dummy": None}}
     try:
-        return jsonify(json.loads(do_messaging(content)))
+        return json_response(do_messaging(content))
     except Exception as err:
         return jsonify({"ERROR": str(err)})
 
@@ -277,7 +314,7 @@ def game_register_name(private_id, public_id, name):
                         "public_id": public_id,
                         "name": name}}
     try:
-        return jsonify(json.loads(do_messaging(content)))
+        return json_response(do_messaging(content))
     except Exception as err:
         return jsonify({"ERROR": str(err)})
 
@@ -289,6 +326,51 @@ def game_status(private_id):
                           "move_dx": 0}}
     return do_messaging(content)
 
+def status_events(private_id):
+    """Server-sent events for /status/stream: the status when it starts,
+    then each update that the backend pushes, until the entry is gone.
+    Renews the watch every STREAM_RENEW sec, which also keeps the player's
+    place like a poll, and sends a comment line then so that a closed
+    connection is noticed.
+    """
+    dispatcher = get_dispatcher()
+    updates = dispatcher.watch(private_id)
+    try:
+        yield web.SSE_START
+        first = True
+        renew_at = 0
+        while True:
+            if time() >= renew_at:
+                body = do_messaging({"watch": {"private_id": private_id}})
+                renew_at = time() + common.STREAM_RENEW
+                if not web.renewal_is_event(body, first):
+                    yield web.SSE_KEEP_ALIVE
+                    continue
+                first = False
+            else:
+                try:
+                    body = updates.get(timeout=max(0, renew_at - time()))
+                except queue.Empty:
+                    continue
+            yield web.sse_event(body)
+            if web.ends_stream(body):
+                return
+    finally:
+        dispatcher.unwatch(private_id, updates)
+
+@app.route("/status/stream")
+def game_status_stream():
+    """Pushes the player's status as server-sent events whenever their
+    state or queue position changes, instead of /status being polled.
+    Each open stream holds a worker thread, so serve it with the gthread
+    or gevent worker class (or from async_server).
+    """
+    private_id = request.args.get('private_id', default=None)
+    if not utils.is_private_id(private_id):
+        return jsonify({"ERROR": "Invalid private id"})
+    return Response(status_events(private_id), mimetype='text/event-stream',
+                    headers=web.SSE_HEADERS)
+
 @app.route("/cancel")
 @returns_json
 def game_cancel(private_id):
@@ -402,6 +484,17 @@ def setup_app(app):
     log.make_log(app)
     log.info("Starting up instance of app")
     app._this_instance = uuid.uuid4().hex
+    if not hasattr(app, '_rq'):
+        app._rq = redis.from_url(os.environ.get('REDIS_URL',
+                                                'redis://localhost:6379'))
+    app._router = web.new_router()
+    window = web.publish_batch_window()
+    if window:
+        app._publisher = BatchPublisher(app._rq, window,
+                                        common.PUBLISH_MAX_BATCH)
+    else:
+        app._publisher = None
+    app._admission = web.new_admission_limit()
     settings = 'dev_settings' #'production_settings'
     log.info("Using " + settings)
     # essential to get everything started with WSGI
@@ -411,6 +504,8 @@ setup_app(app)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    # not under gunicorn, whose on_starting does this (see metrics.py)
+    metrics.clear()
     # make it public, ensure DEBUG off to prevent remote python code execution
     #from scout_apm.flask import ScoutApm # in-app monitoring
     #ScoutApm(app)
@@ -419,4 +514,4 @@ if __name__ == '__main__':
     #app.config['SCOUT_NAME']    = ""
     app.run(host="0.0.0.0", port=port, debug=True)
     # web: #python aping_pong/flask_server.py
-    # gunicorn -b 0.0.0.0:$PORT -w 3 -k gevent wsgi:application --log-file -
+    # gunicorn queue_app.flask_server:app  (settings in gunicorn.conf.py)
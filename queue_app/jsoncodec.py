@@ -0,0 +1,38 @@
+"""JSON encoding for backend messages and HTTP responses.
+
+Uses orjson or ujson when one is installed (several times faster than the
+standard library) and the json module otherwise. dumps() always returns
+compact UTF-8 bytes, and loads() accepts bytes or str, whichever codec is
+in use.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    try:
+        import ujson
+    except ImportError:
+        ujson = None
+
+if orjson is not None:
+    name = 'orjson'
+    dumps = orjson.dumps
+    loads = orjson.loads
+elif ujson is not None:
+    name = 'ujson'
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    loads = ujson.loads
+else:
+    name = 'json'
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+    loads = json.loads
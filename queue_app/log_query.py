@@ -0,0 +1,222 @@
+"""Time-range queries and counts over logs written by logger.initialize_logger
+(app.log, game.log, error.log), without reading the whole file.
+
+Each file is memory-mapped and given a sparse index: the offset and
+timestamp of the first record after every `step` bytes, found by probing
+rather than scanning. A query binary-searches the index and only reads the
+span it asks for. Timestamps ("%Y-%m-%d %H:%M:%S,%f", msec) are compared as
+raw bytes, which sort the same way as the times they stand for, so nothing
+is parsed per line.
+
+    python -m queue_app.log_query logs/app.log --start "2026-10-18 14:00" \\
+        --end "2026-10-18 15:00" --timeouts-per-minute
+"""
+
+import argparse
+import bisect
+import collections
+import datetime
+import heapq
+import mmap
+import os
+import re
+import sys
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+# start of a record: "<asctime> <LEVEL> - "
+_RECORD_START = re.compile(rb'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) ')
+_STAMP_LEN = 23
+
+TIMEOUT_MESSAGE = b"Waited too long for response"
+DUPLICATE_MESSAGE = b"Duplicate message from client"
+
+
+def to_stamp(t):
+    """Timestamp bytes for a datetime or a string in any leading part of
+    TIMESTAMP_FORMAT (e.g. "2026-10-18 14:05"), for use as a query bound.
+    """
+    if isinstance(t, datetime.datetime):
+        t = t.strftime(TIMESTAMP_FORMAT)[:_STAMP_LEN]
+    if isinstance(t, str):
+        t = t.encode('ascii')
+    return t
+
+
+class LogIndex(object):
+    def __init__(self, path, step=1 << 16):
+        self.path = path
+        self.step = step
+        self._file = open(path, 'rb')
+        self._map = None
+        self.size = 0
+        # parallel lists, in file order
+        self.stamps = []
+        self.offsets = []
+        self.refresh()
+
+    def refresh(self):
+        """Map any data appended since the last call and index it.
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self.size:
+            return
+        if size < self.size:
+            # truncated (the loggers open in "w" mode), start over
+            self.stamps, self.offsets = [], []
+            self.size = 0
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) \
+                        if size else b''
+        pos = self.offsets[-1] + 1 if self.offsets else 0
+        self.size = size
+        while pos < size:
+            start = self._record_at_or_after(pos)
+            if start is None:
+                break
+            self.stamps.append(self._map[start:start+_STAMP_LEN])
+            self.offsets.append(start)
+            pos = max(start + 1, pos + self.step)
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def _record_at_or_after(self, pos):
+        """Offset of the first record starting at or after pos, or None.
+        """
+        m = self._map
+        if pos > 0 and m[pos-1:pos] != b'\n':
+            pos = m.find(b'\n', pos) + 1
+            if pos == 0:
+                return None
+        while pos < self.size:
+            if _RECORD_START.match(m, pos):
+                return pos
+            pos = m.find(b'\n', pos) + 1
+            if pos == 0:
+                return None
+        return None
+
+    def span(self, start=None, end=None):
+        """Byte offsets (lo, hi) of the records with start <= time < end.
+        Either bound may be None for an open range.
+        """
+        self.refresh()
+        if start is None:
+            lo = 0
+        else:
+            start = to_stamp(start)
+            # the last indexed record before start, then scan forward
+            i = bisect.bisect_left(self.stamps, start) - 1
+            lo = self._first_at_or_after(self.offsets[i] if i >= 0 else 0, start)
+        if end is None:
+            hi = self.size
+        else:
+            end = to_stamp(end)
+            i = bisect.bisect_left(self.stamps, end) - 1
+            hi = self._first_at_or_after(max(lo, self.offsets[i] if i >= 0 else 0), end)
+        return lo, max(lo, hi)
+
+    def _first_at_or_after(self, pos, stamp):
+        m = self._map
+        while True:
+            pos = self._record_at_or_after(pos)
+            if pos is None:
+                return self.size
+            if m[pos:pos+_STAMP_LEN] >= stamp:
+                return pos
+            pos += 1
+
+    def records(self, start=None, end=None):
+        """Yields (stamp, text) per record in the range, text being the
+        record's lines (continuation lines included) as bytes.
+        """
+        lo, hi = self.span(start, end)
+        m = self._map
+        pos = lo
+        while pos < hi:
+            nxt = self._record_at_or_after(pos + 1)
+            if nxt is None or nxt > hi:
+                nxt = hi
+            yield m[pos:pos+_STAMP_LEN], m[pos:nxt]
+            pos = nxt
+
+    def count(self, pattern, start=None, end=None, key=None):
+        """Counter of the lines in the range matching the regex `pattern`
+        (bytes). Without `key`, counts per value of the pattern's group 1 (or
+        the whole match, if it has no groups); key='minute' or 'hour' counts
+        per minute or hour of the line's timestamp instead. Lines are found
+        with one regex pass over the mapped span.
+        """
+        lo, hi = self.span(start, end)
+        if key == 'minute':
+            width = 16
+        elif key == 'hour':
+            width = 13
+        elif key is not None:
+            raise ValueError("key must be None, 'minute' or 'hour'")
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        line_pat = re.compile(rb'^(?:' + _RECORD_START.pattern + rb')?.*?(' +
+                              pattern + rb')', re.M)
+        value = 3 if line_pat.groups > 2 else 2
+        counts = collections.Counter()
+        for mt in line_pat.finditer(self._map, lo, hi):
+            if key is None:
+                counts[mt.group(value)] += 1
+            elif mt.group(1):
+                # continuation lines have no stamp of their own
+                counts[mt.group(1)[:width]] += 1
+        return counts
+
+    def timeouts_per_minute(self, start=None, end=None):
+        return self.count(re.escape(TIMEOUT_MESSAGE), start, end, key='minute')
+
+    def duplicates_per_client(self, start=None, end=None):
+        return self.count(re.escape(DUPLICATE_MESSAGE) + rb' (\w+)', start, end)
+
+
+def merged_records(indexes, start=None, end=None):
+    """Records of several logs in the range, in time order.
+    """
+    return heapq.merge(*[index.records(start, end) for index in indexes],
+                       key=lambda rec: rec[0])
+
+
+def _main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('paths', nargs='+', help="log files")
+    parser.add_argument('--start', help="e.g. '2026-10-18 14:00'")
+    parser.add_argument('--end', help="exclusive")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--timeouts-per-minute', action='store_true')
+    group.add_argument('--duplicates-per-client', action='store_true')
+    group.add_argument('--count', metavar='REGEX',
+                       help="count matching lines per minute")
+    args = parser.parse_args(argv)
+    indexes = [LogIndex(path) for path in args.paths]
+    out = sys.stdout.buffer
+    if args.timeouts_per_minute or args.duplicates_per_client or args.count:
+        totals = collections.Counter()
+        for index in indexes:
+            if args.timeouts_per_minute:
+                totals.update(index.timeouts_per_minute(args.start, args.end))
+            elif args.duplicates_per_client:
+                totals.update(index.duplicates_per_client(args.start, args.end))
+            else:
+                totals.update(index.count(args.count.encode(), args.start,
+                                          args.end, key='minute'))
+        for k in sorted(totals):
+            out.write(k + b" " + str(totals[k]).encode() + b"\n")
+    else:
+        for _, text in merged_records(indexes, args.start, args.end):
+            out.write(text)
+    for index in indexes:
+        index.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -4,15 +4,19 @@
 import logging
 import os
 import sys
-import fileinput
+import gzip
+import heapq
+import operator
 import re
-from time import strptime
 import datetime
 import ast
 import queue_app.utils
 import json
 import socket
-from logging.handlers import SysLogHandler
+import atexit
+import threading
+from logging.handlers import SysLogHandler, QueueHandler
+from queue_app import common
 
 
 def initialize_logger(output_dir='logs',
@@ -102,17 +106,76 @@ def initialize_logger(output_dir='logs',
     return logger
 
 
-def merge_logs(file_paths, sort_on_time=False, timestamp_format='%a %b %d %H:%M:%S %Y'):
-    """Beware of sorting logs that use multi-line groups per record and which originate
-    from concurrent processes.
+def _open_log(path):
+    """Text-mode file object, decompressing gzip files (e.g. rotated logs,
+    recognized by content, not name).
     """
-    lines = list(fileinput.input(file_paths))
-    if sort_on_time:
-        t_pat = re.compile(r'\[(.+?)\]') # pattern to extract timestamp
-        return sorted(lines, key=lambda l: strptime(t_pat.search(l).group(1),
-                                                    timestamp_format))
-    else:
-        return lines
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def _log_records(path, t_pat, timestamp_format):
+    """Yields (time, lines) per record of one log file. A record starts at a
+    line with a parsable timestamp and takes all following lines without one
+    (e.g. tracebacks). Lines before the first timestamp get datetime.min.
+    """
+    t = datetime.datetime.min
+    last_stamp = None
+    lines = []
+    with _open_log(path) as f:
+        for line in f:
+            m = t_pat.search(line)
+            if m is not None:
+                stamp = m.group(1)
+                if stamp != last_stamp:
+                    # consecutive records often share a stamp
+                    try:
+                        new_t = datetime.datetime.strptime(stamp, timestamp_format)
+                    except ValueError:
+                        m = None
+                    else:
+                        last_stamp = stamp
+                else:
+                    new_t = t
+            if m is None:
+                lines.append(line)
+                continue
+            if lines:
+                yield t, lines
+            t = new_t
+            lines = [line]
+    if lines:
+        yield t, lines
+
+
+def merge_logs(file_paths, sort_on_time=False,
+               timestamp_format='%a %b %d %H:%M:%S %Y',
+               timestamp_pattern=r'\[(.+?)\]'):
+    """Generator over the lines of all the log files (plain or gzipped), in
+    order of file_paths, or if sort_on_time is True, merged by timestamp.
+
+    Merging assumes each file is already in time order (as a log written by
+    one process is) and only holds one record per file in memory. Records
+    spanning several lines stay together, and records with equal times keep
+    the order of file_paths. The timestamp is group 1 of the
+    timestamp_pattern regex; for the app's own logs use
+    timestamp_pattern=r'^(\S+ \S+) ' and
+    timestamp_format='%Y-%m-%d %H:%M:%S,%f'.
+    """
+    if not sort_on_time:
+        for path in file_paths:
+            with _open_log(path) as f:
+                for line in f:
+                    yield line
+        return
+    t_pat = re.compile(timestamp_pattern)
+    streams = [_log_records(path, t_pat, timestamp_format) for path in file_paths]
+    for t, lines in heapq.merge(*streams, key=operator.itemgetter(0)):
+        for line in lines:
+            yield line
 
 class StdErrLoggerWriter:
     def __init__(self, level):
@@ -147,7 +210,154 @@ class ContextFilter(logging.Filter):
         return True
 
 
+# message arguments that cannot change before the listener formats them
+_IMMUTABLE_ARGS = frozenset([str, bytes, int, float, bool, type(None)])
+
+
+class LazyQueueHandler(QueueHandler):
+    """Puts records on the listener's queue, to be formatted later in the
+    listener's thread. Only records whose arguments are all immutable
+    scalars go as they are: any other argument (a dict of game state, say)
+    could change or be freed by then, so such a message is formatted now.
+    """
+    def __init__(self, listener):
+        QueueHandler.__init__(self, listener.queue)
+        self.listener = listener
+
+    def prepare(self, record):
+        args = record.args
+        if args and not (isinstance(args, tuple) and
+                         all(type(arg) in _IMMUTABLE_ARGS for arg in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        self.listener.ensure_running()
+        self.listener.queue.put(record)
+
+
+_BATCHED_HANDLERS = (logging.StreamHandler, logging.FileHandler)
+
+
+class BatchingQueueListener(object):
+    """Background thread that takes records off the queue in batches, writes
+    each batch to the wrapped handlers and flushes them once per batch.
+    """
+    def __init__(self, queue_size, handlers, batch_size=256):
+        self.queue_size = queue_size
+        self.queue = None
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = False
+        if hasattr(os, 'register_at_fork'):
+            # don't fork in the middle of a write, or the child inherits a
+            # file buffer that is locked for good
+            os.register_at_fork(before=self._write_lock.acquire,
+                                after_in_parent=self._write_lock.release,
+                                after_in_child=self._write_lock.release)
+
+    def ensure_running(self):
+        # (re)start lazily: a thread started before a fork is not running
+        # in the child, and the queue's lock may have been copied held
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue_app.utils.simpleFIFO(
+                            maxsize=self.queue_size, overflow='drop_oldest')
+                    self._pid = os.getpid()
+                    self._stop = False
+                    self._thread = threading.Thread(target=self._run,
+                                            name="log-writer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        q = self.queue
+        while not self._stop:
+            batch = q.get_many(self.batch_size, block=True, timeout=0.5)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        with self._write_lock:
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        for handler in self.handlers:
+            # only plain file and stream handlers: a subclass may do more
+            # in emit (rotate, reconnect) than write to its stream
+            if type(handler) in _BATCHED_HANDLERS and \
+                       handler.stream is not None:
+                # write the whole batch under one lock, then flush once
+                handler.acquire()
+                try:
+                    for record in batch:
+                        if record.levelno >= handler.level and handler.filter(record):
+                            try:
+                                handler.stream.write(handler.format(record) +
+                                                     handler.terminator)
+                            except Exception:
+                                handler.handleError(record)
+                    handler.flush()
+                finally:
+                    handler.release()
+            else:
+                for record in batch:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+    def stop(self):
+        """Write out whatever is still queued (used at exit).
+        """
+        if self._pid != os.getpid():
+            return
+        self._stop = True
+        self._thread.join(2)
+        batch = self.queue.get_many(len(self.queue))
+        if batch:
+            self._write(batch)
+
+
+def use_async_handlers(logger, queue_size=100000):
+    """Move the logger's handlers behind a queue serviced by a background
+    thread, so that callers never wait on disk or network. If the writer
+    falls behind, the oldest records are dropped first.
+    """
+    listener = BatchingQueueListener(queue_size, logger.handlers[:])
+    listener.ensure_running()
+    for handler in listener.handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(LazyQueueHandler(listener))
+    atexit.register(listener.stop)
+    return listener
+
+
+class VirtualLogHandler(logging.Handler):
+    """Keeps the latest formatted records in a utils.VirtualLog, for the
+    /log_tail admin endpoint.
+    """
+    def __init__(self, size, level=logging.INFO):
+        logging.Handler.__init__(self, level)
+        self.lines = queue_app.utils.VirtualLog(size)
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)s - %(message)s"))
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
 class LogClass(object):
+    def __init__(self):
+        self._sample_counts = {}
+        # this process's latest lines, see make_log
+        self.recent = queue_app.utils.VirtualLog(1)
+
     def make_log(self, app=None):
         if 'DYNO' in os.environ:
             # papertrail
@@ -185,21 +395,40 @@ class LogClass(object):
                                         overwrite_log_files=True)
             if app is not None:
                 app.logger = log_object
+        tail = VirtualLogHandler(common.LOG_TAIL_SIZE)
+        log_object.addHandler(tail)
+        self.recent = tail.lines
+        if common.ASYNC_LOGGING or os.environ.get('ASYNC_LOGGING'):
+            use_async_handlers(log_object)
         self.logger = log_object
 
-    def info(self, msg):
-        self.logger.info(msg)
+    def sampled(self, key):
+        """True for 1 in every 1/rate calls per key, where the rate comes
+        from common.LOG_SAMPLE_RATES (default: log every call). Use it to
+        thin out chatty per-request lines.
+        """
+        rate = common.LOG_SAMPLE_RATES.get(key, 1)
+        if rate >= 1:
+            return True
+        n = self._sample_counts.get(key, 0)
+        self._sample_counts[key] = n + 1
+        return n % int(round(1/rate)) == 0
+
+    # extra args are %-formatted only if the record is actually written
+
+    def info(self, msg, *args):
+        self.logger.info(msg, *args)
 
-    def warning(self, msg):
-        self.logger.warning(msg)
+    def warning(self, msg, *args):
+        self.logger.warning(msg, *args)
 
-    def error(self, msg):
-        self.logger.error(msg)
+    def error(self, msg, *args):
+        self.logger.error(msg, *args)
 
-    def critical(self, msg):
-        self.logger.critical(msg)
+    def critical(self, msg, *args):
+        self.logger.critical(msg, *args)
 
-    def debug(self, msg):
-        self.logger.debug(msg)
+    def debug(self, msg, *args):
+        self.logger.debug(msg, *args)
 
 log = LogClass()
@@ -0,0 +1,325 @@
+"""Routing of backend replies to the web requests waiting for them.
+
+Each worker process owns one dispatcher. A single listener (a background
+thread for the WSGI app, a task for the asyncio app) reads the worker's reply
+channel ("client-" + instance) and hands each reply to the request that is
+waiting for it, matched on the ``_msg_id`` correlation ID that is attached to
+every outgoing command. Waiting requests block on a future, so nothing spins
+while the backend is busy.
+
+Replies are framed as b"<msg_id> <JSON body>", so they can be routed without
+decoding the body, which is handed to the request as bytes. One message may
+carry several frames separated by newlines.
+
+Status updates that the backend pushes for a watched private_id (see
+/status/stream) are framed as b"@<private_id> <JSON body>" and go to every
+queue registered with watch() for that id in this worker.
+
+With batching on, a BatchPublisher (or AsyncBatchPublisher) coalesces the
+commands a worker publishes within a few milliseconds into one message,
+{"batch": [command, ...]}, per channel.
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import Future, TimeoutError as ReplyTimeout
+from queue_app.logger import log
+from queue_app.metrics import metrics
+
+
+class _ReplyRouter(object):
+    """Bookkeeping shared by the sync and asyncio dispatchers.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self._waiting = {}
+        self._watchers = {}  # private_id -> list of queues
+        self._lock = threading.Lock()
+        # replies that arrived with nobody waiting (late or duplicated)
+        self.discarded = 0
+
+    def _new_future(self):
+        raise NotImplementedError
+
+    def _new_queue(self):
+        raise NotImplementedError
+
+    def _route(self, raw):
+        if isinstance(raw, str):
+            raw = raw.encode('utf-8')
+        for frame in raw.split(b'\n'):
+            self._route_frame(frame)
+
+    def _route_frame(self, raw):
+        msg_id, sep, body = raw.partition(b' ')
+        if not sep:
+            log.error("Unroutable message on {}: {}".format(self.channel, raw))
+            return
+        msg_id = msg_id.decode('ascii', 'replace')
+        if msg_id.startswith('@'):
+            with self._lock:
+                queues = list(self._watchers.get(msg_id[1:], ()))
+            for q in queues:
+                q.put_nowait(body)
+            return
+        with self._lock:
+            # left for wait() to remove: the reply may beat it here
+            fut = self._waiting.get(msg_id)
+        if fut is None or fut.done():
+            # the request already timed out, or the backend repeated itself
+            self.discarded += 1
+            metrics.inc('queue_app_duplicate_replies_total')
+            log.error("Duplicate message from client {}: {}".format(self.channel[7:], raw))
+        else:
+            fut.set_result(body)
+
+    def expect(self):
+        """Register interest in a reply before publishing the command.
+        Returns the correlation ID to attach to the command.
+        """
+        msg_id = uuid.uuid4().hex
+        with self._lock:
+            self._waiting[msg_id] = self._new_future()
+        return msg_id
+
+    def cancel(self, msg_id):
+        with self._lock:
+            self._waiting.pop(msg_id, None)
+
+    def watch(self, private_id):
+        """Queue that receives the JSON body of every status update pushed
+        for private_id, until unwatch().
+        """
+        q = self._new_queue()
+        with self._lock:
+            self._watchers.setdefault(private_id, []).append(q)
+        return q
+
+    def unwatch(self, private_id, q):
+        with self._lock:
+            queues = self._watchers.get(private_id, [])
+            if q in queues:
+                queues.remove(q)
+            if not queues:
+                self._watchers.pop(private_id, None)
+
+    def flush(self):
+        """Return the number of replies discarded since the last flush.
+        """
+        count, self.discarded = self.discarded, 0
+        return count
+
+
+class ReplyDispatcher(_ReplyRouter):
+    def __init__(self, redis_conn, channel, poll_timeout=1.0):
+        """redis_conn must provide the redis-py pubsub() API.
+
+        poll_timeout (sec) only bounds how long the listener thread takes to
+        notice stop(); it is not a busy-wait interval.
+        """
+        _ReplyRouter.__init__(self, channel)
+        self._rq = redis_conn
+        self.poll_timeout = poll_timeout
+        self._stop = threading.Event()
+        self._thread = None
+        self._pubsub = None
+
+    def _new_future(self):
+        return Future()
+
+    def _new_queue(self):
+        return queue.Queue()
+
+    def start(self):
+        # subscribe before returning so that no reply can be published
+        # to the channel before somebody is listening
+        self._pubsub = self._rq.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+        self._thread = threading.Thread(target=self._listen,
+                                        name="reply-dispatcher-"+self.channel,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._pubsub.close()
+
+    def _listen(self):
+        while not self._stop.is_set():
+            try:
+                msg = self._pubsub.get_message(timeout=self.poll_timeout)
+            except Exception as err:
+                log.error("Reply listener error on {}: {}".format(self.channel, err))
+                self._stop.wait(self.poll_timeout)
+                continue
+            if msg is not None:
+                self._route(msg['data'])
+
+    def wait(self, msg_id, timeout):
+        """Block until the reply for msg_id arrives and return its JSON body.
+        Raises ReplyTimeout if it does not arrive within timeout seconds.
+        """
+        with self._lock:
+            fut = self._waiting[msg_id]
+        try:
+            return fut.result(timeout)
+        finally:
+            self.cancel(msg_id)
+
+
+class AsyncReplyDispatcher(_ReplyRouter):
+    """asyncio counterpart of ReplyDispatcher. All methods must be called
+    from the event loop that ran start().
+    """
+    def __init__(self, redis_conn, channel):
+        """redis_conn must provide the redis.asyncio pubsub() API.
+        """
+        _ReplyRouter.__init__(self, channel)
+        self._rq = redis_conn
+        self._task = None
+        self._pubsub = None
+
+    def _new_future(self):
+        return asyncio.get_event_loop().create_future()
+
+    def _new_queue(self):
+        return asyncio.Queue()
+
+    async def start(self):
+        self._pubsub = self._rq.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.ensure_future(self._listen())
+        return self
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self._pubsub.close()
+
+    async def _listen(self):
+        while True:
+            try:
+                async for msg in self._pubsub.listen():
+                    if msg is not None and msg['type'] == 'message':
+                        self._route(msg['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                log.error("Reply listener error on {}: {}".format(self.channel, err))
+                await asyncio.sleep(1)
+
+    async def wait(self, msg_id, timeout):
+        """Await the reply for msg_id and return its JSON body.
+        Raises asyncio.TimeoutError if it does not arrive in time.
+        """
+        fut = self._waiting[msg_id]
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self.cancel(msg_id)
+
+
+def batch_message(payloads):
+    """One message for several JSON-encoded commands (bytes), or the command
+    itself if there is only one.
+    """
+    if len(payloads) == 1:
+        return payloads[0]
+    return b'{"batch":[' + b','.join(payloads) + b']}'
+
+
+class BatchPublisher(object):
+    """Publishes commands in batches from a background thread: a batch goes
+    out `window` sec after its first command arrived, or as soon as it has
+    `max_batch` commands. Costs each request up to `window` sec of latency
+    in exchange for far fewer broker messages under load.
+
+    publish() only queues the command, so a failure to publish is logged
+    here and the waiting requests time out.
+    """
+    def __init__(self, redis_conn, window=0.002, max_batch=64):
+        self._rq = redis_conn
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._full = False
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def publish(self, channel, payload):
+        with self._cond:
+            if self._pid != os.getpid():
+                # threads do not survive a fork
+                self._pid = os.getpid()
+                self._pending = {}
+                threading.Thread(target=self._run, name="batch-publisher",
+                                 daemon=True).start()
+            if not self._pending:
+                self._cond.notify()
+            items = self._pending.setdefault(channel, [])
+            items.append(payload)
+            if len(items) >= self.max_batch and not self._full:
+                self._full = True
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                self._cond.wait_for(lambda: self._full, self.window)
+                pending, self._pending = self._pending, {}
+                self._full = False
+            for channel, items in pending.items():
+                for i in range(0, len(items), self.max_batch):
+                    part = items[i:i+self.max_batch]
+                    metrics.observe('queue_app_publish_batch_size', len(part))
+                    try:
+                        self._rq.publish(channel, batch_message(part))
+                    except Exception as err:
+                        log.error("Lost {} commands for {}: {}".format(len(part), channel, err))
+
+
+class AsyncBatchPublisher(object):
+    """asyncio counterpart of BatchPublisher, flushing from a timer on the
+    event loop that first calls publish().
+    """
+    def __init__(self, redis_conn, window=0.002, max_batch=64):
+        self._rq = redis_conn
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}
+        self._timer = None
+
+    def publish(self, channel, payload):
+        items = self._pending.setdefault(channel, [])
+        items.append(payload)
+        if len(items) >= self.max_batch:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window,
+                                                              self._flush)
+
+    def _flush(self):
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        for channel, items in pending.items():
+            metrics.observe('queue_app_publish_batch_size', len(items))
+            asyncio.ensure_future(self._send(channel, batch_message(items), len(items)))
+
+    async def _send(self, channel, message, n):
+        try:
+            await self._rq.publish(channel, message)
+        except Exception as err:
+            log.error("Lost {} commands for {}: {}".format(n, channel, err))
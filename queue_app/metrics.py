@@ -0,0 +1,206 @@
+"""In-process counters and latency histograms, summed over all worker
+processes on the host and rendered in the Prometheus text format.
+
+Updating a metric is a dict update under a lock. Every few seconds a
+background thread writes the process's totals to
+<METRICS_DIR>/<pid>-<random>.json (the pid alone could be reused by a later
+worker, overwriting the totals of the exited one); render() adds up those
+files. Files of exited workers are kept, so that
+counters never go backwards while the server runs. clear() them when the
+server (re)starts: gunicorn.conf.py does in on_starting, and the servers'
+__main__ (as run by ProcfileHoncho) before app.run.
+"""
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from queue_app import common
+
+# upper bounds in sec, for round trips to the backend
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0)
+# upper bounds in messages
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+# name: (type, help)
+DEFINITIONS = {
+    'queue_app_reply_seconds': ('histogram',
+            "Time from publishing a command to receiving its reply"),
+    'queue_app_reply_timeouts_total': ('counter',
+            "Commands that got no reply within REPLY_TIMEOUT"),
+    'queue_app_duplicate_replies_total': ('counter',
+            "Replies discarded because nobody was waiting for them"),
+    'queue_app_rate_limited_total': ('counter',
+            "Requests rejected by the rate limiter"),
+    'queue_app_shed_total': ('counter',
+            "Backend calls refused with 503 by the worker's concurrency limit"),
+    'queue_app_publish_batch_size': ('histogram',
+            "Commands per message published to the backend (batching on)"),
+    'queue_app_engine_batch_size': ('histogram',
+            "Messages the engine took off its inbox at once"),
+}
+
+# histograms not listed use LATENCY_BUCKETS
+HISTOGRAM_BUCKETS = {
+    'queue_app_publish_batch_size': BATCH_BUCKETS,
+    'queue_app_engine_batch_size': BATCH_BUCKETS,
+}
+
+
+def _buckets(name):
+    return HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS)
+
+
+class Metrics(object):
+    def __init__(self, snapshot_dir, interval=5.0):
+        self.snapshot_dir = snapshot_dir
+        self.interval = interval
+        # (name, labels) -> value, labels being a tuple of (key, value) pairs
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., count over the last, sum]
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._pid = None
+        self._file = None
+
+    def inc(self, name, labels=(), n=1):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + n
+            self._version += 1
+
+    def observe(self, name, value, labels=()):
+        buckets = _buckets(name)
+        i = bisect.bisect_left(buckets, value)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._start()
+            key = (name, labels)
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [0]*(len(buckets) + 2)
+            h[i] += 1
+            h[-1] += value
+            self._version += 1
+
+    def _start(self):
+        # called with the lock held; a forked child starts from zero
+        if self._pid is not None:
+            self.counters = {}
+            self.histograms = {}
+        self._pid = os.getpid()
+        self._file = os.path.join(self.snapshot_dir, "%d-%s.json" % (
+                self._pid, uuid.uuid4().hex[:12]))
+        threading.Thread(target=self._run, name="metrics-writer",
+                         daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        written = None
+        while self._pid == pid:
+            time.sleep(self.interval)
+            if self._version != written:
+                written = self._version
+                try:
+                    self._write()
+                except OSError:
+                    pass
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': [[k[0], k[1], v] for k, v in self.counters.items()],
+                    'histograms': [[k[0], k[1], list(v)]
+                                   for k, v in self.histograms.items()]}
+
+    def _write(self):
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self._file
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def collect(self):
+        """Totals over this process and all snapshot files, as
+        (counters, histograms) dicts keyed like the attributes.
+        """
+        snaps = [self.snapshot()]
+        for path in glob.glob(os.path.join(self.snapshot_dir, "*.json")):
+            if path == self._file:
+                continue
+            try:
+                with open(path) as f:
+                    snaps.append(json.load(f))
+            except (OSError, ValueError):
+                # being replaced, or not ours
+                continue
+        counters = {}
+        histograms = {}
+        for snap in snaps:
+            for name, labels, v in snap['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + v
+            for name, labels, h in snap['histograms']:
+                if len(h) != len(_buckets(name)) + 2:
+                    # written with other buckets
+                    continue
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = list(h)
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, h)]
+        return counters, histograms
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (0.0.4).
+        """
+        counters, histograms = self.collect()
+        by_name = {}
+        for (name, labels), v in sorted(counters.items()):
+            by_name.setdefault(name, []).append(
+                    "{}{} {}".format(name, _labels(labels), v))
+        for (name, labels), h in sorted(histograms.items()):
+            lines = by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(_buckets(name) + ('+Inf',), h[:-1]):
+                cumulative += n
+                lines.append("{}_bucket{} {}".format(name,
+                        _labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, _labels(labels), h[-1]))
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+        out = []
+        for name in sorted(by_name):
+            kind, help_text = DEFINITIONS.get(name, ('untyped', name))
+            out.append("# HELP {} {}".format(name, help_text))
+            out.append("# TYPE {} {}".format(name, kind))
+            out.extend(by_name[name])
+        return "\n".join(out) + "\n"
+
+    def clear(self):
+        """Forget all snapshot files (e.g. at server start).
+        """
+        for path in glob.glob(os.path.join(self.snapshot_dir, "*.json")):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                           .replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + "}"
+
+
+metrics = Metrics(os.environ.get('METRICS_DIR', common.METRICS_DIR))
@@ -0,0 +1,364 @@
+"""Spreading the queue over several engine processes (partitions).
+
+Each partition is a queue_engine run with --partition NAME. The web tier
+routes every command by a consistent hash of its private_id to the
+channels player-in.NAME / admin.NAME of one partition, which then owns that
+player from declare to the end of their game. A declare without a
+private_id is given a fresh one here, so that it is routed (and later found)
+like any other. Commands without a private_id (wakeup, dump) go to every
+partition, and the web tier merges the replies (merge_replies).
+
+The web tier and all engines must be given the same partition list
+(common.PARTITIONS or env var PARTITIONS). Adding or removing a partition
+only moves the keys that hash to it, about 1/N of them; a player who is
+moved mid-queue gets "Unknown private id" and has to declare again.
+
+Cross-partition protocol:
+
+* Game slots: MAX_SIMULTANEOUS_GAMES is split between the partitions
+  (slot_quota), and a partition lends the part of its share that neither
+  its games nor its queue need to partitions that have players waiting,
+  the one whose queue is oldest first. Grants go out with the summaries
+  below ("lend"); a borrower reports the latest grant it has seen from
+  each lender and how many of those slots it holds ("borrow"). A lender
+  keeps a lent slot out of its own use until the borrower has both seen a
+  smaller grant and given the slot back, so the global limit holds however
+  late the summaries are. Lending takes a summary or two, so a partition
+  is busy for about STATS_INTERVAL sec before borrowed slots arrive; and
+  a partition only lends what its own queue does not need, so first-come
+  order holds across partitions only as far as idle slots go. Grants are
+  kept in memory: a partition that restarts may briefly overshoot its
+  share while slots it had lent are still in use.
+* Position: every STATS_INTERVAL sec each partition publishes on
+  STATS_CHANNEL a summary of its queue: the arrival times of every
+  `step`-th queued entry. A player's position is their rank in their own
+  partition plus, for each other partition, the number of entries that
+  arrived there before them, estimated from that summary to within `step`.
+  Summaries older than STATS_EXPIRY sec (a partition that died) are ignored.
+  Arrival times come from each engine's clock, so hosts should run NTP.
+* MAX_PER_IP is enforced per partition.
+"""
+
+import bisect
+import hashlib
+import time
+import uuid
+
+STATS_CHANNEL = 'partition-stats'
+STATS_INTERVAL = 1.0 # sec
+STATS_EXPIRY = 5.0 # sec
+# arrival times sent per summary, at most
+SUMMARY_SIZE = 64
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hashing of string keys onto nodes. Each node is placed
+    at `replicas` points on the ring, so that keys spread evenly and adding
+    a node takes a share of keys from every other node.
+    """
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []  # sorted hashes
+        self._nodes = []   # node at the same index
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return sorted(set(self._nodes))
+
+    def __len__(self):
+        return len(set(self._nodes))
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _hash("{}#{}".format(node, i))
+            j = bisect.bisect(self._points, point)
+            self._points.insert(j, point)
+            self._nodes.insert(j, node)
+
+    def remove(self, node):
+        keep = [(p, n) for p, n in zip(self._points, self._nodes) if n != node]
+        self._points = [p for p, n in keep]
+        self._nodes = [n for p, n in keep]
+
+    def node_for(self, key):
+        if not self._points:
+            raise LookupError("No nodes in the hash ring")
+        i = bisect.bisect(self._points, _hash(key))
+        if i == len(self._points):
+            i = 0
+        return self._nodes[i]
+
+
+def parse_partitions(spec):
+    """Partition names from a setting: a list, a comma-separated string,
+    or a count N meaning "0".."N-1". Empty or None means no partitioning.
+    """
+    if not spec:
+        return []
+    if isinstance(spec, int):
+        return [str(i) for i in range(spec)]
+    if isinstance(spec, str):
+        if spec.isdigit():
+            return [str(i) for i in range(int(spec))]
+        spec = spec.split(',')
+    return [str(name).strip() for name in spec if str(name).strip()]
+
+
+def command_channel(base, partition):
+    return "{}.{}".format(base, partition)
+
+
+def slot_quota(max_games, partitions, partition):
+    """This partition's share of max_games; the first partitions (in list
+    order) get one more if it does not divide evenly.
+    """
+    n = len(partitions)
+    i = partitions.index(partition)
+    return max_games // n + (1 if i < max_games % n else 0)
+
+
+def routing_key(content):
+    """The private_id a command is about, or '' if none. Gives a declare
+    without one a new private_id, in place.
+    """
+    for args in content.values():
+        if isinstance(args, dict) and 'private_id' in args:
+            if args['private_id'] is None and 'declare' in content:
+                args['private_id'] = uuid.uuid4().hex
+            return args['private_id'] or ''
+    return ''
+
+
+class Router(object):
+    """Picks the channel for a command, for the web tier.
+    """
+    def __init__(self, partitions, replicas=100):
+        self.partitions = list(partitions)
+        self.ring = HashRing(self.partitions, replicas)
+
+    def partitions_for(self, content):
+        """The partition that owns the player a command is about, or all of
+        them for a command about none (see merge_replies).
+        """
+        key = routing_key(content)
+        if not key:
+            return list(self.partitions)
+        return [self.ring.node_for(key)]
+
+    def channel(self, content, is_admin=False, partition=None):
+        if partition is None:
+            partition = self.ring.node_for(routing_key(content))
+        return command_channel('admin' if is_admin else 'player-in', partition)
+
+
+class PeerQueues(object):
+    """What one partition knows about the others, from their summaries on
+    STATS_CHANNEL: their queues, and the slots lent between them.
+    """
+    def __init__(self, name, quota=None, expiry=STATS_EXPIRY):
+        self.name = name
+        self.quota = quota
+        self.expiry = expiry
+        self._peers = {}     # name -> (received, summary)
+        self._seq = 0        # of this partition's summaries
+        # as lender, per borrower: slots granted, with the seq of the
+        # summary that first carried the grant, and the largest grant since
+        # lowered that the borrower has not yet confirmed seeing
+        self._grants = {}
+        self._grant_seq = {}
+        self._unconfirmed = {}
+        # as borrower, per lender: slots of its grant that are in use, and
+        # the largest grant seen since the last summary (games may have
+        # started on it since)
+        self._using = {}
+        self._peak = {}
+
+    # --- summaries
+
+    def summary(self, arrivals, used, now):
+        """Summary of this partition, whose queue's arrival times, in
+        queue order, are the list `arrivals` and which has `used` slots
+        taken (pending or playing). Also settles what it lends and borrows.
+        """
+        step = max(1, -(-len(arrivals) // SUMMARY_SIZE))
+        self._seq += 1
+        out = {"partition": self.name, "t": now, "seq": self._seq,
+               "queued": len(arrivals), "step": step,
+               "arrivals": arrivals[::step]}
+        if self.quota is not None:
+            self._forget_expired(now)
+            out["lend"] = self._lend(used, len(arrivals))
+            out["borrow"] = self._borrow(used)
+            out["need"] = max(0, used + len(arrivals) - self._own_slots())
+        return out
+
+    def update(self, summary, now=None):
+        name = summary.get("partition")
+        if name == self.name:
+            return
+        if now is None:
+            now = time.time()
+        if name in self._peers:
+            old = self._peers[name][1].get("lend", {}).get(self.name, 0)
+            self._peak[name] = max(self._peak.get(name, 0), old)
+        self._peers[name] = (now, summary)
+        # the borrower has seen the latest grant: anything lowered before
+        # it is now only held as far as it says it uses it
+        seen = summary.get("borrow", {}).get(self.name)
+        if seen is not None and seen[0] >= self._grant_seq.get(name, 0):
+            self._unconfirmed.pop(name, None)
+
+    def _forget_expired(self, now):
+        for name, (received, summary) in list(self._peers.items()):
+            if now - received > self.expiry:
+                # a partition that died holds no slots (see the module doc)
+                del self._peers[name]
+                self._grants.pop(name, None)
+                self._unconfirmed.pop(name, None)
+
+    # --- slots
+
+    def _borrowers(self):
+        return set(self._grants) | set(self._unconfirmed) | set(self._peers)
+
+    def _in_use(self, borrower):
+        # slots of this partition's quota that `borrower` last said it uses
+        if borrower not in self._peers:
+            return 0
+        summary = self._peers[borrower][1]
+        return summary.get("borrow", {}).get(self.name, [0, 0])[1]
+
+    def _own_slots(self):
+        """This partition's quota less what its borrowers may be using.
+        """
+        held = sum(max(self._grants.get(name, 0),
+                       self._unconfirmed.get(name, 0), self._in_use(name))
+                   for name in self._borrowers())
+        return max(0, self.quota - held)
+
+    def _granted(self):
+        """Slots lent to this partition, by lender.
+        """
+        return {name: summary.get("lend", {}).get(self.name, 0)
+                for name, (received, summary) in self._peers.items()}
+
+    def capacity(self, now):
+        """How many slots this partition may have taken now: its quota
+        less what it lends, plus what is lent to it.
+        """
+        self._forget_expired(now)
+        return self._own_slots() + sum(self._granted().values())
+
+    def _lend(self, used, queued):
+        # what the borrowers may use already cannot be taken back at once
+        # (a grant lowered now stays held until the borrower has seen it);
+        # only the rest of the quota left after this partition's own games
+        # and queue is lent anew, oldest queue first
+        budget = self.quota - used - queued
+        held = {}
+        for name in self._borrowers():
+            held[name] = max(self._grants.get(name, 0),
+                             self._unconfirmed.get(name, 0), self._in_use(name))
+            budget -= held[name]
+        wanting = []
+        for name, (received, summary) in self._peers.items():
+            others = sum(peer.get("lend", {}).get(name, 0)
+                         for other, (r, peer) in self._peers.items()
+                         if other != name)
+            want = summary.get("need", 0) - others
+            if want > 0:
+                head = summary["arrivals"][0] if summary.get("arrivals") \
+                       else float('inf')
+                wanting.append((head, name, want))
+        grants = {}
+        for head, name, want in sorted(wanting):
+            grant = min(want, held[name] + max(0, budget))
+            budget -= max(0, grant - held[name])
+            grants[name] = grant
+        for name in set(self._grants) | set(grants):
+            old, new = self._grants.get(name, 0), grants.get(name, 0)
+            if new < old:
+                self._unconfirmed[name] = max(self._unconfirmed.get(name, 0), old)
+            if new != old:
+                self._grant_seq[name] = self._seq
+        self._grants = {name: g for name, g in grants.items() if g}
+        return dict(self._grants)
+
+    def _borrow(self, used):
+        # which lenders' slots the games beyond the own share are on:
+        # within each grant first, then slots of grants since lowered
+        # (never more than were in use or granted since the last summary),
+        # so that those are given back first
+        granted = self._granted()
+        extra = used - min(used, self._own_slots())
+        using = {}
+        for name in sorted(granted):
+            using[name] = min(granted[name], extra)
+            extra -= using[name]
+        for name in sorted(set(granted) | set(self._using) | set(self._peak)):
+            held = max(self._using.get(name, 0), self._peak.get(name, 0))
+            more = max(0, min(held - using.get(name, 0), extra))
+            using[name] = using.get(name, 0) + more
+            extra -= more
+        self._using = {name: n for name, n in using.items() if n}
+        self._peak = {}
+        return {name: [self._peers[name][1].get("seq", 0)
+                       if name in self._peers else 0,
+                       self._using.get(name, 0)]
+                for name in set(granted) | set(self._using)}
+
+    # --- positions
+
+    def ahead(self, t, now):
+        """Estimated number of entries in other partitions that arrived
+        before time t.
+        """
+        self._forget_expired(now)
+        total = 0
+        for received, summary in self._peers.values():
+            total += min(summary["queued"],
+                         bisect.bisect_left(summary["arrivals"], t) *
+                         summary["step"])
+        return total
+
+    def queued(self, now):
+        self._forget_expired(now)
+        return sum(summary["queued"] for received, summary in self._peers.values())
+
+
+def merge_replies(partitions, replies):
+    """One reply for a command sent to every partition, from their decoded
+    replies (None for no reply): numbers added up, flags and-ed, anything
+    else as the first partition has it; each partition's own reply under
+    "partitions".
+    """
+    merged = {}
+    for reply in replies:
+        if isinstance(reply, dict):
+            _merge_into(merged, reply)
+    for key in ("partition", "queued_elsewhere"):
+        merged.pop(key, None)
+    merged["partitions"] = dict(zip(partitions, replies))
+    missing = [name for name, reply in zip(partitions, replies) if reply is None]
+    if missing:
+        merged["no_reply"] = missing
+    return merged
+
+
+def _merge_into(total, reply):
+    for key, value in reply.items():
+        if isinstance(value, bool):
+            total[key] = total.get(key, True) and value
+        elif isinstance(value, (int, float)) and \
+                isinstance(total.get(key, 0), (int, float)):
+            total[key] = total.get(key, 0) + value
+        elif isinstance(value, dict) and isinstance(total.get(key, {}), dict):
+            _merge_into(total.setdefault(key, {}), value)
+        else:
+            total.setdefault(key, value)
@@ -0,0 +1,740 @@
+#!/usr/bin/env python
+"""Reference queue engine: the backend process that consumes the player-in
+channel, owns the ordered queue of submissions and the game slots, and
+answers the commands published by the web tier. Run one per deployment:
+
+    python -m queue_app.queue_engine [--redis-url URL]
+
+or one per partition (see partitioning.py), e.g. on one or several hosts:
+
+    python -m queue_app.queue_engine --partitions 0,1,2 --partition 0
+
+Lifecycle of a submission (keyed by private_id):
+
+    queued   -> waiting in line; must poll at least every
+                DECLARATION_TIMEOUT sec or it is dropped
+    pending  -> a game slot is reserved; the player must poll within
+                PENDING_TIMEOUT sec to start the game or the slot is released
+    playing  -> holds one of MAX_SIMULTANEOUS_GAMES slots; a game with no
+                move for PENDING_TIMEOUT sec is ended
+    finished -> game over; the result is kept for POST_GAME_TIMEOUT sec
+
+Enqueue, dequeue, cancel and position lookup are O(log n). Timeouts are
+kept in a utils.TimingWheel on the monotonic clock, so setting the system
+clock neither drops nor keeps anybody early or late; the `now` passed to
+the commands is wall time, for game clocks, the journal and logs.
+
+A web worker can watch a private_id for a /status/stream connection: after
+every batch in which some state changed, the engine pushes the status of
+each watched entry whose state or queue position differs from the last one
+sent, as an "@<private_id> <JSON>" frame to each watching worker. A watch
+lasts WATCH_LEASE sec unless renewed, and renewing it counts as a poll.
+
+With a persistence.Journal (--state-dir), every change of state is
+journaled and the engine recovers its queue and slots after a restart:
+restore() loads the last snapshot and replays the journal since. Moves are
+not journaled, so a game in progress comes back as it was at its start.
+Every restored entry gets a full timeout from the restart on, as nobody
+could poll while the engine was down.
+"""
+
+import argparse
+import gc
+import os
+import threading
+import time
+import uuid
+from queue_app import utils
+from queue_app import db
+from queue_app import jsoncodec
+from queue_app import partitioning
+from queue_app import persistence
+from queue_app.metrics import metrics
+from queue_app import common as common
+from queue_app.logger import log
+
+QUEUED = 'queued'
+PENDING = 'pending'
+PLAYING = 'playing'
+FINISHED = 'finished'
+
+GAME_DURATION = 30 # sec, for ReferenceGame at level 0
+WATCH_LEASE = 3 * common.STREAM_RENEW # sec
+
+
+class ReferenceGame(object):
+    """Stand-in for the real game: the player steers a paddle with
+    move_dx for a fixed time, longer at higher levels.
+    """
+    def __init__(self, game_id, level, t):
+        self.game_id = game_id
+        self.level = level
+        self.t_start = t
+        self.duration = GAME_DURATION * (1 + max(0, level))
+        self.x = 0.0
+        self.moves = 0
+        self.over = False
+
+    def step(self, move_dx, t):
+        if t - self.t_start >= self.duration:
+            self.over = True
+        elif move_dx:
+            self.x += move_dx
+            self.moves += 1
+
+    def state(self, t):
+        return {"game_id": self.game_id,
+                "level": self.level,
+                "x": self.x,
+                "moves": self.moves,
+                "time_left": max(0, round(self.t_start + self.duration - t, 1)),
+                "over": self.over}
+
+
+class Entry(object):
+    __slots__ = ('private_id', 'public_id', 'hash_ip', 'anon_ip', 'level',
+                 'name', 'state', 'game', 'queued_at')
+
+    def __init__(self, private_id, public_id, hash_ip, anon_ip, level):
+        self.private_id = private_id
+        self.public_id = public_id
+        self.hash_ip = hash_ip
+        self.anon_ip = anon_ip
+        self.level = level
+        self.name = None
+        self.state = None
+        self.game = None
+        self.queued_at = None
+
+
+class QueueEngine(object):
+    def __init__(self, game_factory=ReferenceGame,
+                 max_games=common.MAX_SIMULTANEOUS_GAMES,
+                 max_per_ip=common.MAX_PER_IP,
+                 allow_same_ip=common.ALLOW_SAME_IP,
+                 event_writer=None, peers=None, ids=None, id_stride=1,
+                 id_offset=0, journal=None, timers=None):
+        """event_writer is an optional db.BufferedWriter for enq_events.
+        peers is a partitioning.PeerQueues when this engine is one partition
+        of several; max_games is then this partition's share, which it may
+        lend and to which it may borrow (see partitioning.py).
+        ids is a utils.IDAllocator for public ids (default: in memory).
+        Partition i of n uses id_stride=n, id_offset=i so that their public
+        ids never clash.
+        journal is an optional persistence.Journal; see restore().
+        timers is a utils.TimingWheel (default: a new one on time.monotonic).
+        """
+        self.game_factory = game_factory
+        self.event_writer = event_writer
+        self.journal = journal
+        self.peers = peers
+        self.max_games = max_games
+        if peers is not None and peers.quota is None:
+            peers.quota = max_games
+        self.entries = {}          # private_id -> Entry
+        self.public_ids = {}       # public_id -> private_id
+        self.queue = utils.IndexedQueue()
+        self.slots_used = 0        # pending + playing
+        self.per_ip = utils.IPAdmissionIndex(max_per_ip, allow_same_ip)
+        # private_id -> when its current state times out
+        self.timers = utils.TimingWheel() if timers is None else timers
+        self.ids = utils.IDAllocator() if ids is None else ids
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+        self._num_games = 0
+        self.timeouts = {QUEUED: 0, PENDING: 0, PLAYING: 0, FINISHED: 0}
+        # private_id -> {reply channel: lease expiry}
+        self.watchers = {}
+        # private_id -> what the watchers were last sent (see _signature)
+        self._watch_sent = {}
+        # bumped on every change of state or queue order
+        self._version = 0
+        self._pushed_version = 0
+
+    # --- state transitions
+
+    def _record(self, kind, *fields):
+        if self.journal is not None:
+            self.journal.record(kind, *fields)
+
+    def _log_event(self, name, entry, now):
+        if self.event_writer is not None:
+            self.event_writer.write(db.enq_event_row(name, entry.hash_ip,
+                                                     entry.anon_ip, now))
+
+    def _set_state(self, entry, state, timeout):
+        self._version += 1
+        entry.state = state
+        self.timers.schedule(entry.private_id, timeout)
+
+    def _refresh(self, entry, timeout):
+        self.timers.schedule(entry.private_id, timeout)
+
+    def _activate(self, entry, now):
+        entry.queued_at = now
+        self.queue.append(entry.private_id)
+        self.per_ip.add_queued(entry.hash_ip)
+        self._set_state(entry, QUEUED, common.DECLARATION_TIMEOUT)
+
+    def _deactivate(self, entry):
+        """Release whatever the entry holds: its queue place or its slot.
+        """
+        if entry.state == QUEUED:
+            self.queue.remove(entry.private_id)
+            self.per_ip.remove(entry.hash_ip, queued=True)
+        elif entry.state in (PENDING, PLAYING):
+            self.slots_used -= 1
+            self.per_ip.remove(entry.hash_ip, queued=False)
+
+    def _forget(self, entry):
+        self._version += 1
+        self._deactivate(entry)
+        self.timers.cancel(entry.private_id)
+        del self.entries[entry.private_id]
+        del self.public_ids[entry.public_id]
+
+    def _finish(self, entry, now):
+        self._deactivate(entry)
+        self._set_state(entry, FINISHED, common.POST_GAME_TIMEOUT)
+
+    def _start_game(self, entry, now):
+        self._num_games += 1
+        self._record('start', now, entry.private_id, self._num_games)
+        entry.game = self.game_factory(self._num_games, entry.level, now)
+        self._log_event('start', entry, now)
+        self._set_state(entry, PLAYING, common.PENDING_TIMEOUT)
+
+    def tick(self, now):
+        """Expire overdue entries and hand free slots to the head of the
+        queue. Cheap when nothing is due.
+        """
+        for private_id in self.timers.advance():
+            entry = self.entries[private_id]
+            self.timeouts[entry.state] += 1
+            self._record('timeout', now, private_id)
+            self._log_event('timeout', entry, now)
+            if entry.state == PLAYING:
+                # abandoned mid-game; keep the result like any other
+                entry.game.over = True
+                self._finish(entry, now)
+            else:
+                self._forget(entry)
+        slots = self._slots(now)
+        while self.slots_used < slots and len(self.queue):
+            entry = self.entries[self.queue.popleft()]
+            self._record('pending', now, entry.private_id)
+            self.slots_used += 1
+            self.per_ip.promote(entry.hash_ip)
+            self._set_state(entry, PENDING, common.PENDING_TIMEOUT)
+
+    def _slots(self, now):
+        if self.peers is None:
+            return self.max_games
+        return self.peers.capacity(now)
+
+    # --- replies
+
+    def _status(self, entry, now):
+        out = {"status": entry.state, "public_id": entry.public_id}
+        if entry.state == QUEUED:
+            out["position"] = self.queue.rank(entry.private_id) + 1
+            if self.peers is not None:
+                out["position"] += self.peers.ahead(entry.queued_at, now)
+        elif entry.game is not None:
+            out["game"] = entry.game.state(now)
+        return out
+
+    def _signature(self, status):
+        # what a watcher is told about: not the game's clock, say
+        return (status.get("status"), status.get("position"),
+                status.get("game", {}).get("over"))
+
+    def _new_public_id(self):
+        idval = self.ids.allocate()
+        return idval, utils.id_code(idval*self.id_stride + self.id_offset)
+
+    # --- commands
+
+    def declare(self, private_id, level, IPaddress, now):
+        if private_id is not None and not utils.is_private_id(private_id):
+            return {"ERROR": "Invalid private id"}
+        if private_id is not None and private_id in self.entries:
+            entry = self.entries[private_id]
+            if entry.state != FINISHED:
+                return self._status(entry, now)
+            # coming back for another game
+            entry.level = level
+            entry.game = None
+            hash_ip = entry.hash_ip
+        else:
+            entry = None
+            anon_ip, hash_ip = utils.process_IP_address(IPaddress)
+        refusal = self.per_ip.check(hash_ip)
+        if refusal is not None:
+            return {"ERROR": refusal}
+        if entry is None:
+            if private_id is None:
+                private_id = uuid.uuid4().hex
+            idval, public_id = self._new_public_id()
+            entry = Entry(private_id, public_id, hash_ip, anon_ip, level)
+            self.entries[private_id] = entry
+            self.public_ids[entry.public_id] = private_id
+            self._record('declare', now, private_id, public_id, hash_ip,
+                         anon_ip, level, idval)
+        else:
+            self._record('declare', now, private_id, None, None, None,
+                         level, None)
+        self._activate(entry, now)
+        self._log_event('declare', entry, now)
+        self.tick(now)
+        out = self._status(entry, now)
+        out["private_id"] = private_id
+        return out
+
+    def action(self, private_id, move_dx, now):
+        entry = self.entries.get(private_id)
+        if entry is None:
+            return {"ERROR": "Unknown private id"}
+        if entry.state == QUEUED:
+            self._refresh(entry, common.DECLARATION_TIMEOUT)
+        elif entry.state == PENDING:
+            self._start_game(entry, now)
+        if entry.state == PLAYING:
+            self._refresh(entry, common.PENDING_TIMEOUT)
+            entry.game.step(move_dx, now)
+            if entry.game.over:
+                self._record('finish', now, private_id, vars(entry.game))
+                self._finish(entry, now)
+                self.tick(now)
+        return self._status(entry, now)
+
+    def cancel(self, private_id, now):
+        entry = self.entries.get(private_id)
+        if entry is None:
+            return {"ERROR": "Unknown private id"}
+        self._log_event('cancel', entry, now)
+        self._record('cancel', now, private_id)
+        self._forget(entry)
+        self.tick(now)
+        return {"status": "cancelled"}
+
+    def register_name(self, private_id, public_id, name, now):
+        entry = self.entries.get(private_id)
+        if entry is None or entry.public_id != public_id:
+            return {"ERROR": "Unknown private id or public id"}
+        entry.name = str(name)[:30]
+        self._record('name', now, private_id, entry.name)
+        return {"success": True, "name": entry.name}
+
+    # --- persistence
+
+    def export_state(self):
+        """Everything restore() needs, as plain lists and dicts. Queued
+        entries come first, in queue order. Games are kept as their
+        attributes, so a game_factory must be a class whose instances can
+        be rebuilt that way.
+        """
+        rows = []
+        for private_id in self.queue:
+            rows.append(self._export_entry(self.entries[private_id]))
+        for entry in self.entries.values():
+            if entry.state != QUEUED:
+                rows.append(self._export_entry(entry))
+        return {"entries": rows,
+                "num_games": self._num_games,
+                "next_id": self.ids.peek(),
+                "timeouts": self.timeouts}
+
+    def _export_entry(self, entry):
+        return [entry.private_id, entry.public_id, entry.hash_ip,
+                entry.anon_ip, entry.level, entry.name, entry.state,
+                entry.queued_at,
+                None if entry.game is None else vars(entry.game)]
+
+    def _restore_game(self, attrs):
+        game = self.game_factory.__new__(self.game_factory)
+        game.__dict__.update(attrs)
+        return game
+
+    def restore(self, state, records, now):
+        """Rebuild the engine (which must be empty) from a snapshot
+        state, or None, and the journal records made after it (see
+        persistence.Journal.load). O(n) in the snapshot, plus O(log n) per
+        record replayed.
+        """
+        journal, self.journal = self.journal, None
+        # the collector would otherwise rescan the new objects many times
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if state is not None:
+                self._load_state(state)
+            for rec in records:
+                self._replay(rec)
+            self._reset_timeouts()
+        finally:
+            self.journal = journal
+            if gc_was_enabled:
+                gc.enable()
+        self._version += 1
+
+    def _load_state(self, state):
+        queued = []
+        queued_ips = []
+        in_game_ips = []
+        entries = self.entries
+        public_ids = self.public_ids
+        for (private_id, public_id, hash_ip, anon_ip, level, name, st,
+             queued_at, game) in state["entries"]:
+            entry = Entry(private_id, public_id, hash_ip, anon_ip, level)
+            entry.name = name
+            entry.state = st
+            entry.queued_at = queued_at
+            if game is not None:
+                entry.game = self._restore_game(game)
+            entries[private_id] = entry
+            public_ids[public_id] = private_id
+            if st == QUEUED:
+                queued.append(private_id)
+                queued_ips.append(hash_ip)
+            elif st in (PENDING, PLAYING):
+                in_game_ips.append(hash_ip)
+        self.slots_used = len(in_game_ips)
+        self.per_ip.load(queued_ips, in_game_ips)
+        self.queue = utils.IndexedQueue(queued)
+        self._num_games = state["num_games"]
+        self.timeouts.update(state["timeouts"])
+        self.ids.advance(state["next_id"] - 1)
+
+    def _replay(self, rec):
+        # the same transitions as the commands that made the records, but
+        # no event logging, and promotions come from their own records
+        kind, t, private_id = rec[0], rec[1], rec[2]
+        if kind == 'declare':
+            public_id, hash_ip, anon_ip, level, idval = rec[3:]
+            entry = self.entries.get(private_id)
+            if entry is None:
+                entry = Entry(private_id, public_id, hash_ip, anon_ip, level)
+                self.entries[private_id] = entry
+                self.public_ids[public_id] = private_id
+                self.ids.advance(idval)
+            else:
+                entry.level = level
+                entry.game = None
+            self._activate(entry, t)
+            return
+        entry = self.entries[private_id]
+        if kind == 'pending':
+            self.queue.remove(private_id)
+            self.slots_used += 1
+            self.per_ip.promote(entry.hash_ip)
+            self._set_state(entry, PENDING, common.PENDING_TIMEOUT)
+        elif kind == 'start':
+            self._num_games = max(self._num_games, rec[3])
+            entry.game = self.game_factory(rec[3], entry.level, t)
+            self._set_state(entry, PLAYING, common.PENDING_TIMEOUT)
+        elif kind == 'finish':
+            entry.game = self._restore_game(rec[3])
+            self._finish(entry, t)
+        elif kind == 'timeout':
+            self.timeouts[entry.state] += 1
+            if entry.state == PLAYING:
+                entry.game.over = True
+                self._finish(entry, t)
+            else:
+                self._forget(entry)
+        elif kind == 'cancel':
+            self._forget(entry)
+        elif kind == 'name':
+            entry.name = rec[3]
+
+    def _reset_timeouts(self):
+        timeout = {QUEUED: common.DECLARATION_TIMEOUT,
+                   PENDING: common.PENDING_TIMEOUT,
+                   PLAYING: common.PENDING_TIMEOUT,
+                   FINISHED: common.POST_GAME_TIMEOUT}
+        by_state = {state: [] for state in timeout}
+        for private_id, entry in self.entries.items():
+            by_state[entry.state].append(private_id)
+        self.timers.clear()
+        for state, private_ids in by_state.items():
+            self.timers.schedule_many(private_ids, timeout[state])
+
+    def watch(self, private_id, channel, now):
+        """Start or renew pushing the status of private_id to `channel`.
+        Also does what a status poll does, and returns the status.
+        """
+        out = self.action(private_id, 0, now)
+        if "ERROR" in out:
+            return out
+        self.watchers.setdefault(private_id, {})[channel] = now + WATCH_LEASE
+        # an unsent change to this entry still goes to the older watchers
+        self._watch_sent.setdefault(private_id, self._signature(out))
+        return out
+
+    def watch_updates(self, now):
+        """Yields (channel, private_id, status) for the watchers that
+        have not yet seen the current state or position of their entry.
+        An entry that no longer exists is reported once, as an error.
+        """
+        if self._version == self._pushed_version:
+            return
+        self._pushed_version = self._version
+        for private_id, channels in list(self.watchers.items()):
+            for channel, expiry in list(channels.items()):
+                if expiry <= now:
+                    del channels[channel]
+            entry = self.entries.get(private_id)
+            if entry is None:
+                status = {"ERROR": "Unknown private id"}
+            else:
+                status = self._status(entry, now)
+            signature = self._signature(status)
+            if channels and signature != self._watch_sent.get(private_id):
+                for channel in channels:
+                    yield channel, private_id, status
+            self._watch_sent[private_id] = signature
+            if not channels or entry is None:
+                del self.watchers[private_id]
+                del self._watch_sent[private_id]
+
+    def wakeup(self, now):
+        return {"awake": True, "version": common.VERSION}
+
+    def dump(self, now):
+        counts = {QUEUED: len(self.queue), PENDING: 0, PLAYING: 0, FINISHED: 0}
+        for entry in self.entries.values():
+            if entry.state != QUEUED:
+                counts[entry.state] += 1
+        counts["slots"] = self._slots(now)
+        counts["timeouts"] = dict(self.timeouts)
+        if self.peers is not None:
+            counts["partition"] = self.peers.name
+            counts["quota"] = self.max_games
+            counts["queued_elsewhere"] = self.peers.queued(now)
+        return counts
+
+    def queue_summary(self, now):
+        """This partition's queue, for the other partitions.
+        """
+        arrivals = [self.entries[key].queued_at for key in self.queue]
+        return self.peers.summary(arrivals, self.slots_used, now)
+
+    def game(self, private_id, game_id, now):
+        entry = self.entries.get(private_id)
+        if entry is None or entry.game is None or \
+                   str(entry.game.game_id) != str(game_id):
+            return {"ERROR": "No such game"}
+        out = entry.game.state(now)
+        out["name"] = entry.name
+        return out
+
+    def handle(self, content, now, is_admin=False):
+        """Run the command in a decoded message and return the reply dict.
+        """
+        try:
+            if 'action' in content:
+                args = content['action']
+                return self.action(args['private_id'],
+                                   float(args.get('move_dx', 0)), now)
+            elif 'declare' in content:
+                args = content['declare']
+                return self.declare(args['private_id'], int(args['level']),
+                                    args['IPaddress'], now)
+            elif 'cancel' in content:
+                return self.cancel(content['cancel']['private_id'], now)
+            elif 'register_name' in content:
+                args = content['register_name']
+                return self.register_name(args['private_id'],
+                                          args['public_id'], args['name'], now)
+            elif 'watch' in content:
+                return self.watch(content['watch']['private_id'],
+                                  "client-"+content['client'], now)
+            elif 'wakeup' in content:
+                return self.wakeup(now)
+            elif is_admin and 'dump' in content:
+                return self.dump(now)
+            elif is_admin and 'game' in content:
+                args = content['game']
+                return self.game(args['private_id'], args['game_id'], now)
+            else:
+                return {"ERROR": "Unknown command"}
+        except (KeyError, TypeError, ValueError) as err:
+            return {"ERROR": "Invalid command: {}".format(err)}
+
+
+def replies_for(engine, channel, raw, now):
+    """Decode one pub/sub message, a command or a {"batch": [...]} of them,
+    and yield (reply channel, reply frame) per command that can be
+    answered. A frame is the command's _msg_id, a space and the reply JSON,
+    which the web tier passes on to the player without decoding it.
+    """
+    try:
+        content = jsoncodec.loads(raw)
+        commands = content['batch'] if 'batch' in content else [content]
+    except (ValueError, TypeError):
+        log.error("Undecodable message on {}: {}".format(channel, raw))
+        return
+    if isinstance(channel, bytes):
+        channel = channel.decode('utf-8')
+    is_admin = (channel.split('.')[0] == 'admin')
+    for content in commands:
+        try:
+            client = content['client']
+            msg_id = content['_msg_id'].encode('ascii')
+        except (TypeError, KeyError, AttributeError, UnicodeError):
+            log.error("Undecodable message on {}: {}".format(channel, raw))
+            continue
+        reply = engine.handle(content, now, is_admin=is_admin)
+        yield "client-"+client, msg_id + b" " + jsoncodec.dumps(reply)
+
+
+def _read_messages(pubsub, inbox, channels, retry_delay=1.0):
+    while True:
+        # an error must not end this thread, or the engine stays up deaf
+        try:
+            msg = pubsub.get_message(timeout=1.0)
+        except Exception as err:
+            log.error("Engine reader error: {}".format(err))
+            time.sleep(retry_delay)
+            try:
+                pubsub.subscribe(*channels)
+            except Exception as err:
+                log.error("Engine reader cannot subscribe again: {}".format(err))
+            continue
+        if msg is not None:
+            inbox.put((msg['channel'], msg['data']))
+
+
+def run(redis_conn, engine, tick=0.1, batch_size=256,
+        inbox_size=common.ENGINE_INBOX_SIZE):
+    """Serve commands until killed. A reader thread moves messages from
+    Redis into a bounded inbox, and this thread drains it in batches. If the
+    engine falls behind, the oldest messages are dropped first (their
+    senders will have timed out anyway), so memory stays capped.
+    A partition also exchanges queue summaries with its peers.
+    """
+    p = redis_conn.pubsub(ignore_subscribe_messages=True)
+    if engine.peers is None:
+        channels = ['player-in', 'admin']
+    else:
+        name = engine.peers.name
+        channels = [partitioning.command_channel('player-in', name),
+                    partitioning.command_channel('admin', name),
+                    partitioning.STATS_CHANNEL]
+    p.subscribe(*channels)
+    if engine.peers is not None:
+        stats_channel = partitioning.STATS_CHANNEL.encode('utf-8')
+        next_summary = 0
+    inbox = utils.simpleFIFO(maxsize=inbox_size, overflow='drop_oldest')
+    threading.Thread(target=_read_messages, args=(p, inbox, channels),
+                     name="engine-reader", daemon=True).start()
+    log.info("Queue engine listening")
+    dropped = 0
+    while True:
+        batch = inbox.get_many(batch_size, block=True, timeout=tick)
+        now = time.time()
+        if batch:
+            metrics.observe('queue_app_engine_batch_size', len(batch))
+        # one message per web worker for all its replies in this batch
+        out = {}
+        for channel, data in batch:
+            if engine.peers is not None and channel == stats_channel:
+                try:
+                    engine.peers.update(jsoncodec.loads(data), now)
+                    # positions may have moved
+                    engine._version += 1
+                except (ValueError, TypeError, KeyError):
+                    log.error("Bad queue summary: {}".format(data))
+                continue
+            for reply_channel, frame in replies_for(engine, channel, data, now):
+                out.setdefault(reply_channel, []).append(frame)
+        engine.tick(now)
+        if engine.journal is not None:
+            # durable before anyone is told
+            engine.journal.commit()
+            if engine.journal.snapshot_due():
+                engine.journal.write_snapshot(engine.export_state())
+        for reply_channel, private_id, status in engine.watch_updates(now):
+            try:
+                frame = b"@" + private_id.encode('ascii') + b" " + \
+                        jsoncodec.dumps(status)
+            except (UnicodeError, TypeError):
+                # declare() lets no such id in, but never die of one
+                log.error("Cannot push status of {!r}".format(private_id))
+                continue
+            out.setdefault(reply_channel, []).append(frame)
+        for reply_channel, frames in out.items():
+            redis_conn.publish(reply_channel, b"\n".join(frames))
+        if engine.peers is not None and now >= next_summary:
+            next_summary = now + partitioning.STATS_INTERVAL
+            redis_conn.publish(partitioning.STATS_CHANNEL,
+                               jsoncodec.dumps(engine.queue_summary(now)))
+        if inbox.dropped != dropped:
+            log.error("Engine inbox overflowed: {} messages dropped so far".format(inbox.dropped))
+            dropped = inbox.dropped
+
+
+if __name__ == "__main__":
+    import redis
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL',
+                                                'redis://localhost:6379'))
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help="where to log enq_events (optional)")
+    parser.add_argument('--tick', type=float, default=0.1,
+                        help="max sec between timeout checks when idle")
+    parser.add_argument('--partitions', default=os.environ.get('PARTITIONS',
+                                                    common.PARTITIONS),
+                        help="all partition names, comma separated, or their "
+                             "number; must match the web tier's")
+    parser.add_argument('--partition', default=None,
+                        help="the partition this engine serves")
+    parser.add_argument('--state-dir', default=os.environ.get('STATE_DIR',
+                                                    common.STATE_DIR),
+                        help="journal and snapshots, to survive restarts "
+                             "(a partition uses its own subdirectory)")
+    parser.add_argument('--id-file', default=os.environ.get('ID_FILE',
+                                                    common.ID_FILE),
+                        help="keeps public ids unique across restarts "
+                             "(a partition appends .<name>)")
+    args = parser.parse_args()
+    partitions = partitioning.parse_partitions(args.partitions)
+    if args.partition is not None and args.partition not in partitions:
+        parser.error("--partition must be one of --partitions")
+    if partitions and args.partition is None:
+        parser.error("--partition is required with --partitions")
+    if len(partitions) > common.MAX_SIMULTANEOUS_GAMES:
+        parser.error("more partitions than MAX_SIMULTANEOUS_GAMES")
+    if partitions:
+        if os.sep in args.partition or args.partition in ('.', '..'):
+            parser.error("--partition must not be a path")
+        # the settings are shared by all partitions, their files must not be
+        if args.state_dir:
+            args.state_dir = os.path.join(args.state_dir, args.partition)
+        if args.id_file:
+            args.id_file = args.id_file + "." + args.partition
+    log.make_log()
+    if args.database_url:
+        writer = db.enq_event_writer(args.database_url)
+    else:
+        writer = None
+    ids = utils.IDAllocator(args.id_file)
+    if partitions:
+        engine = QueueEngine(event_writer=writer, ids=ids,
+                             id_stride=len(partitions),
+                             id_offset=partitions.index(args.partition),
+                             max_games=partitioning.slot_quota(
+                                 common.MAX_SIMULTANEOUS_GAMES, partitions,
+                                 args.partition),
+                             peers=partitioning.PeerQueues(args.partition))
+    else:
+        engine = QueueEngine(event_writer=writer, ids=ids)
+    if args.state_dir:
+        t0 = time.time()
+        engine.journal = persistence.Journal(args.state_dir)
+        state, records = engine.journal.load()
+        engine.restore(state, records, time.time())
+        log.info("Restored {} entries ({} journal records) in {:.3f} sec".format(
+                     len(engine.entries), len(records), time.time() - t0))
+    run(redis.from_url(args.redis_url), engine, tick=args.tick)
@@ -0,0 +1,198 @@
+"""Token-bucket rate limiting with storage shared between worker processes.
+
+Each key (see web.identity) gets a bucket of `burst` tokens that refills
+at `rate` tokens per second; a request spends one token. Pick the storage
+with a URL:
+
+    memory://               this process only
+    mmap:///path/to/file    all processes on this host (e.g. gunicorn workers)
+    redis://host:port/db    all processes on all nodes using that Redis
+
+The memory and mmap checks take a few microseconds.
+"""
+
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+# key hash, tokens, last refill (monotonic sec)
+_SLOT = struct.Struct('<Qdd')
+_PROBES = 8
+
+
+def _key_hash(key):
+    h = int.from_bytes(hashlib.blake2b(key.encode('utf-8'),
+                                       digest_size=8).digest(), 'little')
+    # 0 marks an empty slot
+    return h or 1
+
+
+class MemoryBuckets(object):
+    remote = False
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._buckets = {}
+        self._prune_at = 100000
+        self._lock = threading.Lock()
+
+    def hit(self, key):
+        """Spend a token for key. Returns (allowed, sec until a token is
+        available).
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) >= self._prune_at:
+                self._prune(now)
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last)*self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return True, 0.0
+            self._buckets[key] = (tokens, now)
+        return False, (1 - tokens)/self.rate
+
+    def _prune(self, now):
+        # full buckets carry no information
+        refill = self.burst/self.rate
+        self._buckets = {k: v for k, v in self._buckets.items()
+                         if now - v[1] < refill}
+        # amortized O(1) per hit however many keys are active
+        self._prune_at = max(100000, 2*len(self._buckets))
+
+
+class MmapBuckets(object):
+    """Buckets in a fixed-size open-addressed table in a memory-mapped file,
+    guarded by byte-range locks, so every process on the host shares them.
+    Record locks do not exclude threads of one process, hence the extra
+    thread lock. A key whose probe window is full takes over the least
+    recently used slot there, which at worst hands it a fresh bucket.
+    """
+    remote = False
+
+    def __init__(self, path, rate, burst=None, slots=65536):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.path = path
+        self.slots = slots
+        size = slots * _SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        self._tlock = threading.Lock()
+
+    def hit(self, key):
+        h = _key_hash(key)
+        first = h % (self.slots - _PROBES)
+        start = first * _SLOT.size
+        length = _PROBES * _SLOT.size
+        now = time.monotonic()
+        refill = self.burst/self.rate
+        m = self._map
+        self._tlock.acquire()
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, length, start)
+        try:
+            use = None
+            oldest = None
+            for i in range(_PROBES):
+                off = start + i*_SLOT.size
+                k, tokens, last = _SLOT.unpack_from(m, off)
+                if last > now:
+                    # written before a reboot (the clock is monotonic
+                    # and the file persists): as good as empty
+                    k, tokens, last = 0, self.burst, now
+                if k == h:
+                    use = off
+                    break
+                if k == 0 or now - last >= refill:
+                    # empty, or stale enough that its bucket is full anyway
+                    if use is None:
+                        use = off
+                elif oldest is None or last < oldest[1]:
+                    oldest = (off, last)
+            else:
+                if use is None:
+                    use = oldest[0]
+                tokens, last = self.burst, now
+            tokens = min(self.burst, tokens + max(0.0, now - last)*self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            _SLOT.pack_into(m, use, h, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+            self._tlock.release()
+        if allowed:
+            return True, 0.0
+        return False, (1 - tokens)/self.rate
+
+
+# effect replication lets Redis < 5 accept TIME before a write
+_REDIS_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2])/1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(b[1]) or burst
+local last = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - last)*rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens)/rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'last', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst/rate*1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+class RedisBuckets(object):
+    """Buckets kept in Redis and updated atomically by a Lua script on the
+    server's clock. One round trip per check.
+    """
+    remote = True
+
+    def __init__(self, redis_conn, rate, burst=None, prefix='ratelimit:'):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.prefix = prefix
+        self._script = redis_conn.register_script(_REDIS_SCRIPT)
+
+    def hit(self, key):
+        allowed, wait = self._script(keys=[self.prefix+key],
+                                     args=[self.rate, self.burst])
+        return bool(allowed), float(wait)
+
+
+def from_url(url, rate, burst=None):
+    if url.startswith('memory://'):
+        return MemoryBuckets(rate, burst)
+    elif url.startswith('mmap://'):
+        return MmapBuckets(url[len('mmap://'):], rate, burst)
+    elif url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisBuckets(redis.from_url(url), rate, burst)
+    else:
+        raise ValueError("Unsupported rate limit storage: %s" % url)
+
+
+def retry_after_header(wait):
+    """Whole seconds for a Retry-After header.
+    """
+    return str(max(1, int(math.ceil(wait))))
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from queue_app import sql_defs as sql
 from queue_app import utils
+from queue_app import db
 import sys
 
 def reset_DBs(db_url):
@@ -12,11 +13,19 @@ def reset_DBs(db_url):
         utils.change_sql(drop_query_template.format(tab), db_url)
     utils.change_sql(sql.create_enq_events_query, db_url)
 
+def migrate(db_url):
+    """Non-destructive schema setup, e.g. as a release step:
+    python queue_app/reset_DB.py <db url> --migrate
+    """
+    db.install_stats_totals(db_url)
+
 if __name__ == "__main__":
-    try:
-        reset_DBs(sys.argv[1])
-    except KeyError:
+    if len(sys.argv) < 2:
         print("Invalid arguments. Must pass full DB url to file")
         sys.exit(2)
+    if '--migrate' in sys.argv[2:]:
+        migrate(sys.argv[1])
+        print("Migrated")
     else:
+        reset_DBs(sys.argv[1])
         print("All DBs reset")
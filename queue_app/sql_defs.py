@@ -3,8 +3,9 @@
 
 # timestamp format: 2014-10-18 21:31:12
 
+# "index" is quoted as it is a keyword in sqlite
 create_enq_events_query = """CREATE TABLE IF NOT EXISTS enq_events (
-index     SERIAL PRIMARY KEY,
+"index"   SERIAL PRIMARY KEY,
 name      VARCHAR(10) NOT NULL,
 hash_ip   VARCHAR(32) NOT NULL,
 anon_ip   VARCHAR(15) NOT NULL,
@@ -12,7 +13,109 @@ timestamp VARCHAR(19) NOT NULL
 );
 """
 
-enq_query_base = ("INSERT INTO _events (type, hash_ip, anon_ip,"
-                      "timestamp) VALUES ('{name}', '{hash_ip}', '{anon_ip}',"
-                      "'{timestamp}');")
+enq_events_columns = ('name', 'hash_ip', 'anon_ip', 'timestamp')
 
+# parameterized: pass values separately (see db.py), never format them in
+enq_query_base = ("INSERT INTO enq_events (name, hash_ip, anon_ip, "
+                  "timestamp) VALUES (%s, %s, %s, %s);")
+
+# Running totals for /stats_totals, kept up to date by triggers on the
+# counted tables so that reading them never scans those tables. Each total
+# is spread over STATS_TOTAL_SHARDS rows, one picked at random per change
+# and summed on read, so that concurrent writers rarely wait on one row.
+# Installed by reset_DB.py --migrate (db.install_stats_totals). Where a
+# column must be non-NULL, updates that set or clear it count too.
+# (name in stats_totals, counted table, column that must be non-NULL)
+stats_totals_sources = [('game_events', 'game_event_log', None),
+                        ('games', 'game_summary', 'game_id')]
+
+STATS_TOTAL_SHARDS = 16
+
+create_stats_totals_query = """CREATE TABLE IF NOT EXISTS stats_total_shards (
+name      VARCHAR(32) NOT NULL,
+shard     INTEGER NOT NULL,
+value     BIGINT NOT NULL,
+PRIMARY KEY (name, shard)
+);
+"""
+
+# the single-row table it replaces
+drop_old_stats_totals_query = "DROP TABLE IF EXISTS stats_totals;"
+
+# one-off seed, only if the shard is not there yet: shard 0 from a full
+# count, the others from 0
+seed_stats_total_query = ("INSERT INTO stats_total_shards (name, shard, value) "
+                          "SELECT '{name}', {shard}, {value} "
+                          "WHERE NOT EXISTS (SELECT 1 FROM stats_total_shards "
+                          "WHERE name = '{name}' AND shard = {shard});")
+full_count_query = "(SELECT COUNT({column}) FROM {table})"
+
+read_stats_totals_query = ("SELECT name, SUM(value), COUNT(*) "
+                           "FROM stats_total_shards GROUP BY name;")
+
+pg_stats_totals_functions = ["""CREATE OR REPLACE FUNCTION stats_totals_bump() RETURNS trigger AS $$
+DECLARE
+    s integer := floor(random()*%d);
+    d integer := CASE TG_OP WHEN 'INSERT' THEN 1 WHEN 'DELETE' THEN -1
+                 ELSE TG_ARGV[1]::integer END;
+BEGIN
+    UPDATE stats_total_shards SET value = value + d
+        WHERE name = TG_ARGV[0] AND shard = s;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;""" % STATS_TOTAL_SHARDS,
+"""CREATE OR REPLACE FUNCTION stats_totals_zero() RETURNS trigger AS $$
+BEGIN
+    UPDATE stats_total_shards SET value = 0 WHERE name = TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;"""]
+
+pg_stats_totals_triggers = [
+    "DROP TRIGGER IF EXISTS {table}_count_ins ON {table};",
+    "CREATE TRIGGER {table}_count_ins AFTER INSERT ON {table} FOR EACH ROW "
+    "{when_new} EXECUTE PROCEDURE stats_totals_bump('{name}');",
+    "DROP TRIGGER IF EXISTS {table}_count_del ON {table};",
+    "CREATE TRIGGER {table}_count_del AFTER DELETE ON {table} FOR EACH ROW "
+    "{when_old} EXECUTE PROCEDURE stats_totals_bump('{name}');",
+    "DROP TRIGGER IF EXISTS {table}_count_trunc ON {table};",
+    "CREATE TRIGGER {table}_count_trunc AFTER TRUNCATE ON {table} "
+    "FOR EACH STATEMENT EXECUTE PROCEDURE stats_totals_zero('{name}');",
+    ]
+
+# for a counted column: updates that set it count +1, that clear it -1
+pg_stats_totals_update_triggers = [
+    "DROP TRIGGER IF EXISTS {table}_count_set ON {table};",
+    "CREATE TRIGGER {table}_count_set AFTER UPDATE OF {column} ON {table} "
+    "FOR EACH ROW WHEN (OLD.{column} IS NULL AND NEW.{column} IS NOT NULL) "
+    "EXECUTE PROCEDURE stats_totals_bump('{name}', '1');",
+    "DROP TRIGGER IF EXISTS {table}_count_clear ON {table};",
+    "CREATE TRIGGER {table}_count_clear AFTER UPDATE OF {column} ON {table} "
+    "FOR EACH ROW WHEN (OLD.{column} IS NOT NULL AND NEW.{column} IS NULL) "
+    "EXECUTE PROCEDURE stats_totals_bump('{name}', '-1');",
+    ]
+
+# sqlite has one writer at a time anyway, so its triggers use shard 0
+sqlite_stats_totals_triggers = [
+    "DROP TRIGGER IF EXISTS {table}_count_ins;",
+    "CREATE TRIGGER {table}_count_ins AFTER INSERT ON {table} "
+    "{when_new} BEGIN UPDATE stats_total_shards SET value = value + 1 "
+    "WHERE name = '{name}' AND shard = 0; END;",
+    "DROP TRIGGER IF EXISTS {table}_count_del;",
+    "CREATE TRIGGER {table}_count_del AFTER DELETE ON {table} "
+    "{when_old} BEGIN UPDATE stats_total_shards SET value = value - 1 "
+    "WHERE name = '{name}' AND shard = 0; END;",
+    ]
+
+sqlite_stats_totals_update_triggers = [
+    "DROP TRIGGER IF EXISTS {table}_count_set;",
+    "CREATE TRIGGER {table}_count_set AFTER UPDATE OF {column} ON {table} "
+    "WHEN (OLD.{column} IS NULL AND NEW.{column} IS NOT NULL) "
+    "BEGIN UPDATE stats_total_shards SET value = value + 1 "
+    "WHERE name = '{name}' AND shard = 0; END;",
+    "DROP TRIGGER IF EXISTS {table}_count_clear;",
+    "CREATE TRIGGER {table}_count_clear AFTER UPDATE OF {column} ON {table} "
+    "WHEN (OLD.{column} IS NOT NULL AND NEW.{column} IS NULL) "
+    "BEGIN UPDATE stats_total_shards SET value = value - 1 "
+    "WHERE name = '{name}' AND shard = 0; END;",
+    ]
@@ -0,0 +1,32 @@
+from queue_app import db
+
+
+def test_stats_totals_follow_inserts_updates_and_deletes(tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'stats.db')
+    pool = db.get_pool(url)
+    pool.execute_all([
+        "CREATE TABLE game_event_log (game_id INTEGER, name TEXT);",
+        "CREATE TABLE game_summary (game_id INTEGER, name TEXT);",
+        "INSERT INTO game_summary VALUES (1, 'a');",
+        "INSERT INTO game_summary VALUES (NULL, 'b');",
+        "INSERT INTO game_summary VALUES (NULL, 'c');"])
+    db.install_stats_totals(url)
+    assert db.stats_totals(url) == {'game_events': 0, 'games': 1}
+    pool.execute_all([
+        "INSERT INTO game_event_log VALUES (1, 'x');",
+        "UPDATE game_event_log SET game_id = NULL;",
+        "UPDATE game_summary SET game_id = 2 WHERE name = 'b';",
+        "UPDATE game_summary SET game_id = 3 WHERE name = 'c';",
+        "UPDATE game_summary SET game_id = 4, name = 'd' WHERE name = 'c';",
+        "UPDATE game_summary SET game_id = NULL WHERE name = 'a';",
+        "DELETE FROM game_summary WHERE name = 'a';",
+        "INSERT INTO game_summary VALUES (5, 'e');"])
+    counts = {'game_events': "SELECT COUNT(*) FROM game_event_log;",
+              'games': "SELECT COUNT(game_id) FROM game_summary;"}
+    expected = {name: pool.fetchall(query)[0][0]
+                for name, query in counts.items()}
+    assert expected == {'game_events': 1, 'games': 3}
+    assert db.stats_totals(url) == expected
+    # the migration can run again without counting twice
+    db.install_stats_totals(url)
+    assert db.stats_totals(url) == expected
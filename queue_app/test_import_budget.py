@@ -0,0 +1,16 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import import_budget
+
+
+def test_web_tier_imports_within_budget():
+    # a cold start is what a dyno wake-up or a recycled worker pays
+    pytest.importorskip('flask')
+    best = import_budget.best_import_seconds(runs=3)
+    assert best <= import_budget.BUDGET, \
+        "import of {} took {:.3f} s, budget {:.3f} s (see {})".format(
+            import_budget.MODULE, best, import_budget.BUDGET,
+            "benchmarks/import_budget.py --top 15")
@@ -0,0 +1,37 @@
+import io
+import logging
+import os
+from logging.handlers import RotatingFileHandler
+from queue_app import logger
+
+
+def _async_logger(name, handlers):
+    log = logging.getLogger(name)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    for handler in handlers:
+        log.addHandler(handler)
+    return log, logger.use_async_handlers(log)
+
+
+def test_mutable_arguments_are_formatted_when_logged():
+    stream = logging.StreamHandler(io.StringIO())
+    log, listener = _async_logger('test_logger.args', [stream])
+    state = {'queued': 1}
+    log.info("state %s of %d", state, 2)
+    log.info("map %(a)s", {'a': state})
+    state['queued'] = 5
+    listener.stop()
+    assert stream.stream.getvalue().splitlines() == [
+        "state {'queued': 1} of 2", "map {'queued': 1}"]
+
+
+def test_subclassed_handlers_emit_each_record(tmp_path):
+    path = str(tmp_path / 'app.log')
+    rotating = RotatingFileHandler(path, maxBytes=200, backupCount=2)
+    log, listener = _async_logger('test_logger.rotating', [rotating])
+    for i in range(40):
+        log.info("line %d", i)
+    listener.stop()
+    rotating.close()
+    assert os.path.exists(path + '.1')
@@ -0,0 +1,19 @@
+from queue_app import metrics
+
+
+def test_snapshots_of_a_reused_pid_are_kept(tmp_path):
+    # two Metrics in one process stand for an exited worker and a later
+    # one that was given the same pid
+    exited = metrics.Metrics(str(tmp_path))
+    exited.inc('queue_app_rate_limited_total', n=2)
+    exited.observe('queue_app_reply_seconds', 0.003)
+    exited._write()
+    later = metrics.Metrics(str(tmp_path))
+    later.inc('queue_app_rate_limited_total')
+    later._write()
+    counters, histograms = later.collect()
+    assert counters[('queue_app_rate_limited_total', ())] == 3
+    assert histograms[('queue_app_reply_seconds', ())][-1] == 0.003
+    assert 'queue_app_rate_limited_total 3' in later.render()
+    later.clear()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,102 @@
+import random
+from queue_app import jsoncodec
+from queue_app import partitioning
+from queue_app import queue_engine
+
+
+def _partitions(names, max_games):
+    return {name: queue_engine.QueueEngine(
+                max_games=partitioning.slot_quota(max_games, names, name),
+                peers=partitioning.PeerQueues(name),
+                max_per_ip=10**6, allow_same_ip=True)
+            for name in names}
+
+
+def _run(engines, steps, rng, arrive, finish, max_games):
+    """Random arrivals and game ends, with summaries that arrive late but
+    in order. Returns the most slots ever taken at once.
+    """
+    names = sorted(engines)
+    now = 1000.0
+    in_flight = []
+    most = 0
+    for step in range(steps):
+        now += 0.05
+        name = arrive(step)
+        if name is not None:
+            engines[name].declare("%032x" % rng.getrandbits(128), 0,
+                                  "10.0.%d.%d" % (step // 250, step % 250), now)
+        for engine in engines.values():
+            for private_id, entry in list(engine.entries.items()):
+                if entry.state == 'pending':
+                    engine.action(private_id, 0, now)
+                elif entry.state == 'playing' and rng.random() < finish:
+                    engine.cancel(private_id, now)
+        for i, name in enumerate(names):
+            if step % 20 == i * 3:
+                summary = jsoncodec.loads(jsoncodec.dumps(
+                        engines[name].queue_summary(now)))
+                for other in names:
+                    if other != name:
+                        in_flight.append((now + rng.uniform(0, 1.5), other,
+                                          summary))
+        waiting = []
+        blocked = set()
+        for t, to, summary in in_flight:
+            key = (summary["partition"], to)
+            if t <= now and key not in blocked:
+                engines[to].peers.update(summary, now)
+                engines[to].tick(now)
+            else:
+                waiting.append((t, to, summary))
+                blocked.add(key)
+        in_flight = waiting
+        used = sum(engine.slots_used for engine in engines.values())
+        assert used <= max_games, step
+        most = max(most, used)
+    return most
+
+
+def test_lent_slots_never_exceed_the_global_limit():
+    for seed in range(4):
+        rng = random.Random(seed)
+        engines = _partitions(['0', '1', '2', '3'], 9)
+        _run(engines, 3000, rng,
+             lambda step: rng.choice('0123' if (step // 750) % 2 else '01')
+                          if rng.random() < 0.15 else None,
+             0.01, 9)
+
+
+def test_idle_quota_is_lent_and_taken_back():
+    rng = random.Random(1)
+    engines = _partitions(['0', '1', '2'], 6)
+    # 5 players on partition 0, whose own share is 2
+    most = _run(engines, 200, rng,
+                lambda step: '0' if step < 5 else None, 0, 6)
+    assert engines['0'].slots_used == 5 and most == 5
+    # partition 1 gets players; its lent slots come back as games end
+    _run(engines, 2000, rng, lambda step: '1' if step < 2 else None,
+         0.002, 6)
+    assert not len(engines['1'].queue)
+
+
+def test_merge_replies():
+    merged = partitioning.merge_replies(['0', '1'], [
+        {"queued": 2, "slots": 3, "timeouts": {"queued": 1}, "awake": True,
+         "partition": "0", "version": "v"},
+        {"queued": 1, "slots": 2, "timeouts": {"queued": 0}, "awake": True,
+         "partition": "1", "version": "v"}])
+    assert merged["queued"] == 3 and merged["slots"] == 5
+    assert merged["timeouts"] == {"queued": 1} and merged["awake"] is True
+    assert "partition" not in merged and merged["version"] == "v"
+    assert merged["partitions"]["1"]["queued"] == 1
+    merged = partitioning.merge_replies(['0', '1'], [{"awake": True}, None])
+    assert merged["no_reply"] == ['1']
+
+
+def test_keyless_commands_go_to_every_partition():
+    router = partitioning.Router(['0', '1', '2'])
+    assert router.partitions_for({"dump": {}}) == ['0', '1', '2']
+    content = {"declare": {"private_id": None, "level": 0}}
+    assert len(router.partitions_for(content)) == 1
+    assert content["declare"]["private_id"]
@@ -0,0 +1,42 @@
+import os
+from queue_app import persistence
+
+
+def _journal_path(directory):
+    return os.path.join(str(directory), persistence.JOURNAL)
+
+
+def _write_records(directory, kinds):
+    journal = persistence.Journal(str(directory))
+    journal.load()
+    for kind in kinds:
+        journal.record(kind)
+    journal.close()
+
+
+def test_torn_tail_is_cut_before_appending(tmp_path):
+    _write_records(tmp_path, ['a', 'b', 'c'])
+    # a crash in the middle of writing record 4
+    with open(_journal_path(tmp_path), 'ab') as f:
+        f.write(b'[4,"jo')
+    journal = persistence.Journal(str(tmp_path))
+    state, records = journal.load()
+    assert records == [['a'], ['b'], ['c']]
+    journal.record('d')
+    journal.record('e')
+    journal.close()
+    state, records = persistence.Journal(str(tmp_path)).load()
+    assert records == [['a'], ['b'], ['c'], ['d'], ['e']]
+
+
+def test_line_without_newline_is_torn(tmp_path):
+    _write_records(tmp_path, ['a'])
+    with open(_journal_path(tmp_path), 'ab') as f:
+        f.write(b'[2,"b"]')
+    journal = persistence.Journal(str(tmp_path))
+    state, records = journal.load()
+    assert records == [['a']]
+    journal.record('c')
+    journal.close()
+    state, records = persistence.Journal(str(tmp_path)).load()
+    assert records == [['a'], ['c']]
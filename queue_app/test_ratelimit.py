@@ -0,0 +1,54 @@
+import pytest
+from queue_app import ratelimit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture(params=['memory', 'mmap'])
+def new_buckets(request, tmp_path):
+    def new_buckets(rate, burst=None):
+        if request.param == 'memory':
+            return ratelimit.MemoryBuckets(rate, burst)
+        return ratelimit.MmapBuckets(str(tmp_path / 'buckets'), rate, burst,
+                                     slots=64)
+    return new_buckets
+
+
+def test_burst_then_refill(clock, new_buckets):
+    buckets = new_buckets(2, burst=3)
+    assert [buckets.hit('a')[0] for _ in range(3)] == [True]*3
+    allowed, wait = buckets.hit('a')
+    assert not allowed and wait == pytest.approx(0.5)
+    # other keys have their own bucket
+    assert buckets.hit('b') == (True, 0.0)
+    clock[0] += 0.25
+    allowed, wait = buckets.hit('a')
+    assert not allowed and wait == pytest.approx(0.25)
+    clock[0] += 0.25
+    assert buckets.hit('a')[0]
+    assert not buckets.hit('a')[0]
+    # refills up to the burst, no more
+    clock[0] += 60
+    assert [buckets.hit('a')[0] for _ in range(4)] == [True]*3 + [False]
+
+
+def test_mmap_buckets_are_shared(clock, tmp_path):
+    path = str(tmp_path / 'buckets')
+    workers = [ratelimit.MmapBuckets(path, 1, burst=2, slots=64)
+               for _ in range(2)]
+    assert workers[0].hit('a')[0] and workers[1].hit('a')[0]
+    assert not workers[0].hit('a')[0] and not workers[1].hit('a')[0]
+    clock[0] += 1
+    assert workers[1].hit('a')[0] and not workers[0].hit('a')[0]
+
+
+def test_rate_limited_answer():
+    from queue_app import web
+    body, status, headers = web.rate_limited(0.2)
+    assert status == 429 and headers == {"Retry-After": "1"}
+    assert web.rate_limited(2.5)[2] == {"Retry-After": "3"}
@@ -0,0 +1,155 @@
+import random
+import pytest
+from queue_app import utils
+
+
+def test_indexed_queue_matches_a_list():
+    rng = random.Random(0)
+    queue = utils.IndexedQueue(capacity=16)
+    model = []
+    n = 0
+    # enough appends to compact the slots several times
+    for step in range(5000):
+        r = rng.random()
+        if r < 0.5 or not model:
+            queue.append(n)
+            model.append(n)
+            n += 1
+        elif r < 0.75:
+            key = rng.choice(model)
+            queue.remove(key)
+            model.remove(key)
+        else:
+            assert queue.popleft() == model.pop(0)
+        assert len(queue) == len(model)
+        if model:
+            key = rng.choice(model)
+            assert queue.rank(key) == model.index(key)
+            i = rng.randrange(len(model))
+            assert queue.key_at(i) == model[i]
+            assert queue.peek() == model[0]
+    assert list(queue) == model
+
+
+def test_indexed_queue_errors():
+    queue = utils.IndexedQueue(['a', 'b'])
+    with pytest.raises(ValueError):
+        queue.append('a')
+    with pytest.raises(IndexError):
+        queue.key_at(2)
+    queue.discard('x')
+    assert queue.key_at(1) == 'b' and 'a' in queue
+
+
+def test_timing_wheel_fires_on_time():
+    rng = random.Random(0)
+    clock = [100.0]
+    # a small wheel (64 ticks in all), so that long delays go round again
+    wheel = utils.TimingWheel(resolution=1.0, bits=3, levels=2,
+                              clock=lambda: clock[0])
+    due = {}
+    for step in range(4000):
+        r = rng.random()
+        key = rng.randrange(200)
+        if r < 0.4:
+            delay = rng.choice([rng.uniform(0, 10), rng.uniform(0, 300)])
+            wheel.schedule(key, delay)
+            due[key] = clock[0] + delay
+        elif r < 0.45:
+            keys = rng.sample(range(200), 5)
+            delay = rng.uniform(0, 100)
+            wheel.schedule_many(keys, delay)
+            due.update(dict.fromkeys(keys, clock[0] + delay))
+        elif r < 0.55:
+            wheel.cancel(key)
+            due.pop(key, None)
+        clock[0] += rng.choice([0.25, 0.5, 3.0])
+        now = clock[0]
+        for key in wheel.advance():
+            # never early
+            assert due.pop(key) <= now
+        # at most one tick late
+        assert all(t > now - wheel.resolution for t in due.values())
+        assert len(wheel) == len(due)
+
+
+class _Event(object):
+    def __init__(self, time, n):
+        self.time = time
+        self.n = n
+
+
+def _time_ordered_q_run(limit, seed):
+    rng = random.Random(seed)
+    q = utils.TimeOrderedQ(limit=limit)
+    # the model: (time, arrival) of each pending event, kept sorted
+    model = []
+    handles = {}
+    n = 0
+    for step in range(3000):
+        r = rng.random()
+        if r < 0.4:
+            # few distinct times, so that many are equal
+            events = [_Event(rng.randrange(20), n + i)
+                      for i in range(rng.choice([1, 1, 1, 40]))]
+            n += len(events)
+            if len(events) == 1:
+                new = [q.insert(events[0])]
+            else:
+                new = q.insert_many(events)
+            for ev, handle in zip(events, new):
+                handles[ev.n] = handle
+                model.append((ev.time, ev.n))
+            model.sort()
+            if limit:
+                # the latest events are dropped
+                del model[limit:]
+        elif r < 0.6 and handles:
+            key = rng.choice(list(handles))
+            handle = handles.pop(key)
+            pending = any(m[1] == key for m in model)
+            assert q.cancel(handle) == pending
+            model = [m for m in model if m[1] != key]
+        else:
+            ev = q.get()
+            if model:
+                # in time order, and in order of arrival for equal times
+                assert (ev.time, ev.n) == model.pop(0)
+            else:
+                assert ev is None
+        assert len(q) == len(model)
+    events, times = q.read()
+    assert [(ev.time, ev.n) for ev in events] == model
+
+
+def test_time_ordered_q_order_and_cancel():
+    _time_ordered_q_run(None, 0)
+
+
+def test_time_ordered_q_limit():
+    for limit in (1, 30):
+        _time_ordered_q_run(limit, limit)
+
+
+@pytest.mark.parametrize('compact_at', [3, 512])
+def test_id_allocator_unique_across_restarts(tmp_path, compact_at):
+    path = str(tmp_path / 'ids')
+    issued = []
+    for restart in range(12):
+        ids = utils.IDAllocator(path, block=4, compact_at=compact_at)
+        issued.extend(ids.allocate() for _ in range(restart + 3))
+        issued.extend(ids.declare_many(5))
+        if restart == 5:
+            ids.advance(issued[-1] + 100)
+            issued.append(ids.allocate())
+        if restart % 2:
+            # a crash in the middle of writing a record
+            with open(path, 'ab') as f:
+                f.write(b'\x07' * (restart % 7 + 1))
+    assert len(set(issued)) == len(issued)
+    assert issued == sorted(issued)
+    # a restart skips only what is left of the last reservation (and
+    # advance() what it is told to), not a limit misread from the file
+    gaps = [b - a for a, b in zip(issued, issued[1:])]
+    assert max(gaps) == 101
+    assert sorted(gaps)[-2] <= 6
@@ -1,23 +1,34 @@
-import pickle
 from operator import itemgetter
 import json
 import os # for Silence and environ
 from os import path
 import collections
+import collections.abc
+import functools
 import string
 from datetime import datetime, timedelta
 import time
-from simplerandom import random
-from hashids import Hashids
 from hashlib import md5
 import base64
+import struct
 import uuid
-import bisect
-from anonymizeip import anonymize_ip
+import heapq
+import itertools
+import threading
 
-hashids = Hashids(salt='hello i am a salt',
-                  alphabet="abcdefghijklmnopqrstuvwxyz0123456789",
-                  min_length=6)
+@functools.lru_cache(maxsize=1 << 16)
+def id_code(idval):
+    """Short public code for an integer id (memoized).
+    """
+    return __getattr__('hashids').encode(idval).upper()
+
+_HEX_DIGITS = frozenset(string.hexdigits)
+
+def is_private_id(s):
+    """True for a private id as issued (uuid4().hex): 32 hex digits. Ids
+    travel in reply frames as they are, so nothing else may pass.
+    """
+    return isinstance(s, str) and len(s) == 32 and _HEX_DIGITS.issuperset(s)
 
 def my_hash(s):
     # [:-2] removes the superfluous '==' at end
@@ -28,7 +39,42 @@ def unix_timestamp_to_str(t=None):
         t = time.time()
     return "{:%Y-%m-%d %H:%M:%S}".format(datetime.fromtimestamp(t))
 
+def change_sql(query, db_url=None, params=()):
+    """Run a statement that returns no rows (see db.py for URL formats).
+    """
+    from queue_app import db
+    db.get_pool(db_url).execute(query, params)
+
+def read_sql(query, db_url=None, params=()):
+    """Run a query and return all its rows as a list of tuples.
+    """
+    from queue_app import db
+    return db.get_pool(db_url).fetchall(query, params)
+
+def cached_for(ttl):
+    """Decorator caching the result of a function of no arguments for ttl
+    seconds.
+    """
+    def decorator(f):
+        cache = []  # [expiry time, value] once filled
+        @functools.wraps(f)
+        def wrapper():
+            now = time.monotonic()
+            if not cache or now >= cache[0]:
+                # races only cost a duplicate call
+                cache[:] = [now + ttl, f()]
+            return cache[1]
+        return wrapper
+    return decorator
+
+# Many clients share an address (NAT, repeat polls), so the anonymized and
+# hashed forms are memoized; the bound keeps memory flat under churn.
+IP_CACHE_SIZE = 65536
+
+@functools.lru_cache(maxsize=IP_CACHE_SIZE)
 def process_IP_address(IPaddress):
+    # imported here: only the queue engine needs it, not the web workers
+    from anonymizeip import anonymize_ip
     anon_IP = anonymize_ip(IPaddress,
                            ipv4_mask="255.255.0.0",
                            ipv6_mask="ffff:ffff:ffff:::"
@@ -37,6 +83,62 @@ def process_IP_address(IPaddress):
     return anon_IP, hash_IP
 
 
+class IPAdmissionIndex(object):
+    """
+    Per hashed IP address, the number of queued and of in-game (pending or
+    playing) submissions, so admission checks are O(1) however many clients
+    share an address.
+    """
+    def __init__(self, max_per_ip, allow_same_ip=True):
+        self.max_per_ip = max_per_ip
+        self.allow_same_ip = allow_same_ip
+        self.counts = {}  # hash_IP -> [queued, in_game]
+
+    def check(self, hash_IP):
+        """Reason why another submission from hash_IP is refused, or None.
+        """
+        try:
+            queued, in_game = self.counts[hash_IP]
+        except KeyError:
+            return None
+        if not self.allow_same_ip:
+            return "Only one submission allowed per IP address"
+        if queued + in_game >= self.max_per_ip:
+            return "Too many submissions from this IP address"
+        return None
+
+    def add_queued(self, hash_IP):
+        try:
+            self.counts[hash_IP][0] += 1
+        except KeyError:
+            self.counts[hash_IP] = [1, 0]
+
+    def load(self, queued, in_game):
+        """Set the counts from scratch, given the hashed IP of every queued
+        and every in-game submission (e.g. when restoring a snapshot).
+        """
+        counts = {h: [n, 0] for h, n in collections.Counter(queued).items()}
+        for h, n in collections.Counter(in_game).items():
+            counts.setdefault(h, [0, 0])[1] = n
+        self.counts = counts
+
+    def promote(self, hash_IP):
+        """One of hash_IP's queued submissions got a game slot.
+        """
+        c = self.counts[hash_IP]
+        c[0] -= 1
+        c[1] += 1
+
+    def remove(self, hash_IP, queued):
+        c = self.counts[hash_IP]
+        c[0 if queued else 1] -= 1
+        if c[0] == c[1] == 0:
+            del self.counts[hash_IP]
+
+    def active(self, hash_IP):
+        return sum(self.counts.get(hash_IP, (0, 0)))
+
+
 # ------------------------------------------
 
 COLOR_RED = (0xff, 0x15, 0x45)
@@ -102,10 +204,28 @@ INV_MAX_ITEMS = 17
 
 # ------------------------------------------
 
-# two instances to control when things get re-seeded or not
-rand_level = random.KISS() # will be re-seeded
-#rand_items = random.KISS() # UNUSED
-rand_always = random.KISS() # will not be seeded
+# two instances to control when things get re-seeded or not:
+# rand_level = random.KISS() # will be re-seeded
+# rand_always = random.KISS() # will not be seeded
+# hashids and these are made on first use (see __getattr__): the web
+# servers import this module but never need them.
+
+def __getattr__(name):
+    value = globals().get(name)
+    if value is not None:
+        return value
+    if name == 'hashids':
+        from hashids import Hashids
+        value = Hashids(salt='hello i am a salt',
+                        alphabet="abcdefghijklmnopqrstuvwxyz0123456789",
+                        min_length=6)
+    elif name in ('rand_level', 'rand_always'):
+        from simplerandom import random
+        value = random.KISS()
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+    return globals().setdefault(name, value)
 
 
 class Silence(object):
@@ -222,50 +342,119 @@ class TimeOrderedQ(object):
     """
     Used for future game-level events and assumes the queue contents are TimerEvent objects
     with a `time` attribute.
+
+    Backed by a binary heap, so insert and get are O(log n). Events with equal
+    times come out in insertion order. insert returns a handle for cancel();
+    cancelled events are dropped lazily when they reach the front. If `limit`
+    is set, the latest events are dropped once more than `limit` are pending.
     """
     def __init__(self, limit=None):
-        self.q = []
-        self.times = []
+        # entries are [time, seq, ev]; seq breaks ties so that events are
+        # never compared, and ev is replaced by _CANCELLED on removal
+        self._heap = []
+        # max-heap of (-time, -seq, entry) to find the latest event, only
+        # maintained when there is a limit to enforce
+        self._tail = []
+        self._seq = itertools.count()
+        self._live = 0
         self.limit = limit
 
+    def __len__(self):
+        return self._live
+
     def test(self, game):
         while True:
-            if self.times == []:
-                break
+            entry = self._peek()
+            if entry is not None and game.t > entry[0]:
+                ev = self.get()
+                ev.do(game)
+                if not ev.one_shot:
+                    # ev reset itself with next time
+                    self.insert(ev)
+                # keep checking
             else:
-                if game.t > self.times[0]:
-                    ev = self.get()
-                    ev.do(game)
-                    if not ev.one_shot:
-                        # ev reset itself with next time
-                        self.insert(ev)
-                    # keep checking
-                else:
-                    break
+                break
+
+    def _peek(self):
+        heap = self._heap
+        while heap and heap[0][2] is _CANCELLED:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
 
     def get(self):
-        try:
-            val = self.q.pop(0)
-        except IndexError:
+        entry = self._peek()
+        if entry is None:
             return None
-        else:
-            # discard first time
-            self.times.pop(0)
-            return val
+        heapq.heappop(self._heap)
+        ev = entry[2]
+        entry[2] = _CANCELLED
+        self._live -= 1
+        return ev
 
     def read(self):
         """Non-destructive read from queue.
         """
-        return self.q, self.times
+        entries = sorted(e for e in self._heap if e[2] is not _CANCELLED)
+        return [e[2] for e in entries], [e[0] for e in entries]
 
     def insert(self, ev):
-        ix = bisect.bisect(self.times, ev.time)
-        self.q.insert(ix, ev)
-        self.times.insert(ix, ev.time)
+        entry = [ev.time, next(self._seq), ev]
+        heapq.heappush(self._heap, entry)
+        self._live += 1
         if self.limit:
-            if len(self.q) > self.limit:
-                self.q.pop(-1)
-                self.times.pop(-1)
+            heapq.heappush(self._tail, (-entry[0], -entry[1], entry))
+            self._trim()
+        return entry
+
+    def insert_many(self, evs):
+        """Bulk insert, returning the handles in the same order as `evs`.
+        """
+        new = [[ev.time, next(self._seq), ev] for ev in evs]
+        heap = self._heap
+        if len(new) > len(heap) // 8:
+            # cheaper to rebuild than to push one at a time
+            heap.extend(new)
+            heapq.heapify(heap)
+        else:
+            for entry in new:
+                heapq.heappush(heap, entry)
+        self._live += len(new)
+        if self.limit:
+            self._tail.extend((-e[0], -e[1], e) for e in new)
+            heapq.heapify(self._tail)
+            self._trim()
+        return new
+
+    def cancel(self, handle):
+        """Remove the event with this handle (as returned by insert).
+        Returns False if it had already left the queue.
+        """
+        if handle[2] is _CANCELLED:
+            return False
+        handle[2] = _CANCELLED
+        self._live -= 1
+        if len(self._heap) > 2*self._live + 64:
+            self._compact()
+        return True
+
+    def _trim(self):
+        tail = self._tail
+        while self._live > self.limit:
+            entry = heapq.heappop(tail)[2]
+            if entry[2] is not _CANCELLED:
+                entry[2] = _CANCELLED
+                self._live -= 1
+        if len(tail) > 2*self._live + 64:
+            self._compact()
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if e[2] is not _CANCELLED]
+        heapq.heapify(self._heap)
+        if self.limit:
+            self._tail = [t for t in self._tail if t[2][2] is not _CANCELLED]
+            heapq.heapify(self._tail)
+
+_CANCELLED = object()
 
 
 class Struct(object):
@@ -276,9 +465,12 @@ class Struct(object):
         return x in self.__dict__
 
 # not needed in python 3
-class OrderedSet(collections.MutableSet):
+class OrderedSet(collections.abc.MutableSet):
     """
     From http://code.activestate.com/recipes/576694/
+
+    Finding an element's position means walking the list; use IndexedQueue
+    for a queue whose positions are asked for.
     """
 
     def __init__(self, iterable=None):
@@ -344,6 +536,122 @@ class OrderedSet(collections.MutableSet):
         return set(self) == set(other)
 
 
+class IndexedQueue(object):
+    """FIFO of hashable keys with O(1) membership, O(log n) removal from
+    the middle, and O(log n) rank (position) lookup and key-at-position,
+    using a Fenwick tree over arrival slots. Slots are compacted once they
+    run out, so the amortized cost of append is O(log n) and memory stays
+    proportional to the live entries.
+    """
+    def __init__(self, iterable=(), capacity=1024):
+        keys = list(iterable)
+        self._reset(max(capacity, 2*len(keys)), keys)
+
+    def _reset(self, capacity, keys):
+        self._cap = capacity
+        self._keys = keys + [None]*(capacity-len(keys))
+        self._slot = {k: i for i, k in enumerate(keys)}
+        if len(self._slot) != len(keys):
+            raise ValueError("Duplicate keys")
+        self._next = len(keys)
+        self._head = 0
+        # linear-time Fenwick build with every used slot live
+        tree = [0]*(capacity+1)
+        for i in range(1, len(keys)+1):
+            tree[i] = 1
+        for i in range(1, capacity+1):
+            j = i + (i & -i)
+            if j <= capacity:
+                tree[j] += tree[i]
+        self._tree = tree
+        self._top = 1 << (capacity.bit_length() - 1)
+
+    def __len__(self):
+        return len(self._slot)
+
+    def __iter__(self):
+        # in queue order
+        for key in self._keys[self._head:self._next]:
+            if key is not None:
+                yield key
+
+    def __contains__(self, key):
+        return key in self._slot
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, list(self))
+
+    def _add(self, slot, delta):
+        i = slot + 1
+        tree = self._tree
+        while i <= self._cap:
+            tree[i] += delta
+            i += i & -i
+
+    def append(self, key):
+        if key in self._slot:
+            raise ValueError("Key already queued: {}".format(key))
+        if self._next == self._cap:
+            live = [k for k in self._keys[self._head:self._next] if k is not None]
+            self._reset(max(1024, 2*len(live)), live)
+        slot = self._next
+        self._next += 1
+        self._keys[slot] = key
+        self._slot[key] = slot
+        self._add(slot, 1)
+
+    def remove(self, key):
+        slot = self._slot.pop(key)
+        self._keys[slot] = None
+        self._add(slot, -1)
+
+    def discard(self, key):
+        if key in self._slot:
+            self.remove(key)
+
+    def rank(self, key):
+        """Number of keys ahead of `key` in the queue.
+        """
+        i = self._slot[key]
+        tree = self._tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def key_at(self, rank):
+        """The key with `rank` keys ahead of it.
+        """
+        if not 0 <= rank < len(self._slot):
+            raise IndexError("Queue index out of range")
+        # descend the tree for the slot where the count reaches rank+1
+        tree = self._tree
+        pos = 0
+        step = self._top
+        while step:
+            nxt = pos + step
+            if nxt <= self._cap and tree[nxt] <= rank:
+                pos = nxt
+                rank -= tree[nxt]
+            step >>= 1
+        return self._keys[pos]
+
+    def peek(self):
+        if not self._slot:
+            return None
+        # amortized O(1): the head only ever moves forward
+        while self._keys[self._head] is None:
+            self._head += 1
+        return self._keys[self._head]
+
+    def popleft(self):
+        key = self.peek()
+        if key is not None:
+            self.remove(key)
+        return key
+
+
 class CycleTimeTester(object):
     def __init__(self, repeat):
         """
@@ -393,6 +701,108 @@ class Unique_id(object):
     def get(self, objtype=''):
         return self.counters[objtype].get_count()
 
+class IDAllocator(object):
+    """Issues increasing integer ids from 1, never the same one twice,
+    including across restarts when given a `path`.
+
+    Ids are reserved `block` at a time, and each reservation appends its
+    upper limit to the file as one 8-byte record, so persisting costs one
+    small write per block. On restart the ids left in the last block are
+    skipped. The file is read (just its last record) on first use, and
+    rewritten to a single record once it has grown past `compact_at`
+    records. Thread safe.
+    """
+    __slots__ = ('path', 'block', 'compact_at', '_next', '_limit',
+                 '_records', '_lock')
+
+    _RECORD = struct.Struct('<Q')
+
+    def __init__(self, path=None, block=1024, compact_at=512):
+        self.path = path
+        self.block = block
+        self.compact_at = compact_at
+        self._next = None
+        self._limit = 0
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        last = 1
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                end = f.seek(0, os.SEEK_END)
+                size = end // 8 * 8
+                if size:
+                    f.seek(size - 8)
+                    last, = self._RECORD.unpack(f.read(8))
+            if size != end:
+                # cut a torn last write, or the next record would be
+                # appended out of step with the 8-byte records
+                os.truncate(self.path, size)
+            self._records = size // 8
+        self._next = self._limit = last
+
+    def _reserve(self, n):
+        # called with the lock held
+        if self._next is None:
+            self._load()
+        if self._next + n <= self._limit:
+            return
+        limit = self._next + max(n, self.block)
+        if self.path is not None:
+            if self._records >= self.compact_at:
+                tmp = self.path + ".tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(self._RECORD.pack(limit))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+                self._records = 1
+            else:
+                with open(self.path, 'ab') as f:
+                    f.write(self._RECORD.pack(limit))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._records += 1
+        self._limit = limit
+
+    def allocate(self):
+        with self._lock:
+            self._reserve(1)
+            idval = self._next
+            self._next += 1
+            return idval
+
+    def peek(self):
+        """The id allocate() would issue next.
+        """
+        with self._lock:
+            self._reserve(1)
+            return self._next
+
+    def advance(self, idval):
+        """Never issue idval or anything below it (e.g. ids restored from a
+        snapshot).
+        """
+        with self._lock:
+            if self._next is None:
+                self._load()
+            if idval >= self._next:
+                self._reserve(idval + 1 - self._next)
+                self._next = idval + 1
+
+    def declare_many(self, n):
+        """A range of n new ids; no per-id objects are made until used.
+        """
+        with self._lock:
+            self._reserve(n)
+            start = self._next
+            self._next += n
+            return range(start, start + n)
+
+    code = staticmethod(id_code)
+
+
 class ItemIDManager(object):
     # all items created in game are permanent!
     def __init__(self):
@@ -405,19 +815,18 @@ class ItemIDManager(object):
         self.uID = Unique_id()
 
     def dump_log(self, prefix=''):
-        from logger import log
+        from queue_app.logger import log
         for idval, item in self.item_lookup.items():
             log.info("{} - Item {} = {} {}".format(prefix, type(item), idval, item.equipment_id))
 
     def declare(self, item):
-        from logger import log #, do_log
         try:
             idval = item.item_id
         except AttributeError:
             # new item, not declared yet
             #_type = item.__class__.__name__
             idval = self.uID.get()
-            eq_idval = hashids.encode(idval).upper()
+            eq_idval = id_code(idval)
             self.item_lookup[idval] = item
             assert eq_idval not in self.eqid_item_lookup, "hash clash on eq_idval"
             assert idval not in self.item_lookup, "hash clash on idval"
@@ -426,7 +835,7 @@ class ItemIDManager(object):
         else:
             if idval in self.item_lookup:
                 # already declared it, duh ...
-                return idval, hashids.encode(idval).upper()
+                return idval, id_code(idval)
             else:
                 # Item ID was not issued in this instance of the server
                 # but was loaded from a previous
@@ -438,7 +847,7 @@ class ItemIDManager(object):
                     eq_idval = item.equipment_id
                     #log.info("Recovered {} ({})".format(eq_idval, type(item)))
                 except AttributeError:
-                    eq_idval = hashids.encode(idval).upper()
+                    eq_idval = id_code(idval)
                     #log.info("Made {} ({})".format(eq_idval, type(item)))
                 #assert eq_idval not in self.eqid_item_lookup, "hash clash on eq_idval"
                 #if eq_idval in self.eqid_item_lookup:
@@ -494,18 +903,77 @@ def argsort(values):
     return sorted(range(len(values)), key=values.__getitem__)
 
 
+class QueueFull(Exception):
+    pass
+
+
 class simpleFIFO(object):
-    def __init__(self):
-        self.q = []
+    """
+    Thread-safe FIFO backed by a deque. With no maxsize it is unbounded and
+    get() returns None when empty, as before.
+
+    With a maxsize, `overflow` sets what put() does when the queue is full:
+        'reject'      -- raise QueueFull
+        'drop_oldest' -- discard the oldest item to make room (counted in
+                         self.dropped)
+        'block'       -- wait up to `timeout` sec for room, then raise
+                         QueueFull
+    """
+    def __init__(self, maxsize=None, overflow='reject'):
+        if overflow not in ('reject', 'drop_oldest', 'block'):
+            raise ValueError("Invalid overflow policy: %s" % overflow)
+        self.q = collections.deque()
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        mutex = threading.Lock()
+        self._not_empty = threading.Condition(mutex)
+        self._not_full = threading.Condition(mutex)
 
-    def put(self, v):
-        self.q.append(v)
+    def __len__(self):
+        return len(self.q)
+
+    def put(self, v, timeout=None):
+        with self._not_full:
+            if self.maxsize and len(self.q) >= self.maxsize:
+                if self.overflow == 'drop_oldest':
+                    self.q.popleft()
+                    self.dropped += 1
+                elif self.overflow == 'block':
+                    if not self._not_full.wait_for(
+                            lambda: len(self.q) < self.maxsize, timeout):
+                        raise QueueFull("Timed out waiting for room")
+                else:
+                    raise QueueFull("Queue is full")
+            self.q.append(v)
+            self._not_empty.notify()
 
-    def get(self):
-        try:
-            return self.q.pop(0)
-        except IndexError:
-            return None
+    def get(self, block=False, timeout=None):
+        """Oldest item, or None if the queue is empty (after waiting up to
+        `timeout` sec if block is True).
+        """
+        with self._not_empty:
+            if block and not self.q:
+                self._not_empty.wait_for(lambda: self.q, timeout)
+            try:
+                v = self.q.popleft()
+            except IndexError:
+                return None
+            self._not_full.notify()
+            return v
+
+    def get_many(self, n, block=False, timeout=None):
+        """Up to n of the oldest items, as a list. If block is True, wait up
+        to `timeout` sec for at least one.
+        """
+        with self._not_empty:
+            if block and not self.q:
+                self._not_empty.wait_for(lambda: self.q, timeout)
+            q = self.q
+            out = [q.popleft() for _ in range(min(n, len(q)))]
+            if out:
+                self._not_full.notify(len(out))
+            return out
 
 def dict_list_add(d, k, v):
     """
@@ -558,29 +1026,51 @@ class VirtualLog(object):
     """
     Abstraction to provide a rolling log of string entries with
     a finite number of entries.
+
+    A preallocated ring buffer: append is O(1) and safe from several
+    threads. Entries are numbered from 0 in order of arrival; `position`
+    is the number of the next one, which read_since() takes and returns so
+    that a reader can fetch only what is new.
     """
     def __init__(self, size=400, input=None):
-        self.log = {}
-        self.cursor = 0
         self.size = size
+        self._entries = [None]*size
+        self.position = 0
+        self._lock = threading.Lock()
         if input is not None:
             for line in input:
                 self.append(line)
 
+    @property
+    def cursor(self):
+        # slot of the next entry
+        return self.position % self.size
+
+    def __len__(self):
+        return min(self.position, self.size)
+
     def append(self, entry_str):
-        self.log[self.cursor] = entry_str
-        self.cursor += 1
-        if self.cursor == self.size:
-            self.cursor = 0
+        with self._lock:
+            self._entries[self.position % self.size] = entry_str
+            self.position += 1
+
+    def read_since(self, position=0):
+        """Returns (entries numbered position and up that are still held,
+        oldest first; the position to pass next time). Entries that were
+        overwritten before being read are skipped.
+        """
+        with self._lock:
+            end = self.position
+            start = max(position, end - self.size, 0)
+            if start >= end:
+                return [], end
+            i, j = start % self.size, end % self.size
+            if i < j:
+                return self._entries[i:j], end
+            return self._entries[i:] + self._entries[:j], end
 
     def read_lines(self):
-        out = []
-        for i in range(self.size):
-            try:
-                out.append(self.log[(self.cursor-1-i)%self.size])
-            except KeyError:
-                break
-        return out[::-1]
+        return self.read_since(0)[0]
 
 
 class Timer(object):
@@ -599,13 +1089,13 @@ class Timer(object):
             while remain < 0:
                 self.over_count += 1
                 remain += self.delay
-            self.t_next = time.time() + remain
+            self.t_next = time.monotonic() + remain
         else:
-            self.t_next = self.delay + time.time()
+            self.t_next = self.delay + time.monotonic()
 
     def __call__(self):
         # poll
-        remain = self.t_next - time.time()
+        remain = self.t_next - time.monotonic()
         if remain <= 0:
             self.reset(remain)
             return True
@@ -625,12 +1115,12 @@ class Timer_OneShot(object):
     def reset(self):
         # manual reset
         self.state = True
-        self.t_next = self.delay + time.time()
+        self.t_next = self.delay + time.monotonic()
 
     def __call__(self):
         # poll
         if self.state:
-            remain = self.t_next - time.time()
+            remain = self.t_next - time.monotonic()
             if remain <= 0:
                 self.state = False
                 self.activate_fn()
@@ -641,16 +1131,152 @@ class Timer_OneShot(object):
             raise ValueError("Timer not running")
 
 
-# These will be overwritten if game level loaded in Game.new
-global unique_item_ids, item_id_man
-try:
-    fl = open("saveIDs.sav", "rb")
-    unique_item_ids, item_id_man = pickle.load(fl)
-except:
-    unique_item_ids = Unique_id()
-    item_id_man = ItemIDManager()
-else:
-    fl.close()
+
+class TimingWheel(object):
+    """Timeouts for many keys on a monotonic clock, so that they are not
+    cut short or stretched when the wall clock is set. schedule (which also
+    reschedules) and cancel are O(1); advance() returns every key that has
+    come due, and costs nothing until a `resolution`-long tick has passed.
+
+    Keys go in one of `levels` wheels of 2**bits slots: level 0 holds the
+    next 2**bits ticks, one slot per tick, and each level above a span
+    2**bits times longer, whose slots are redistributed to the levels below
+    as time reaches them. A timeout fires at most one tick late, never
+    early.
+    """
+    def __init__(self, resolution=0.1, bits=8, levels=4, clock=time.monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        self._bits = bits
+        self._mask = (1 << bits) - 1
+        self._levels = levels
+        self._span = 1 << (bits*levels)
+        self._wheels = [[{} for _ in range(1 << bits)] for _ in range(levels)]
+        self._slot = {}            # key -> the dict it is in
+        self._tick = int(clock() / resolution)
+
+    def __len__(self):
+        return len(self._slot)
+
+    def __contains__(self, key):
+        return key in self._slot
+
+    def _slot_for(self, expiry):
+        # expiry in ticks
+        diff = expiry - self._tick
+        if diff >= self._span:
+            # beyond the top level: park it there, it comes round again
+            level = self._levels - 1
+            at = self._tick + self._span - 1
+        else:
+            level = max(diff.bit_length() - 1, 0) // self._bits
+            at = expiry
+        return self._wheels[level][(at >> (self._bits*level)) & self._mask]
+
+    def _insert(self, key, expiry):
+        slot = self._slot_for(expiry)
+        slot[key] = expiry
+        self._slot[key] = slot
+
+    def _expiry(self, delay):
+        expiry = -int(-(self.clock() + delay) // self.resolution)
+        return max(expiry, self._tick + 1)
+
+    def schedule(self, key, delay):
+        """Fire `key` after `delay` sec, replacing any timeout it had.
+        """
+        where = self._slot
+        old = where.get(key)
+        if old is not None:
+            del old[key]
+        expiry = self._expiry(delay)
+        if expiry - self._tick <= self._mask:
+            slot = self._wheels[0][expiry & self._mask]
+        else:
+            slot = self._slot_for(expiry)
+        slot[key] = expiry
+        where[key] = slot
+
+    def schedule_many(self, keys, delay):
+        """schedule() for many keys with the same delay, at once.
+        """
+        keys = list(keys)
+        for key in keys:
+            self.cancel(key)
+        expiry = self._expiry(delay)
+        slot = self._slot_for(expiry)
+        slot.update(dict.fromkeys(keys, expiry))
+        self._slot.update(dict.fromkeys(keys, slot))
+
+    def cancel(self, key):
+        slot = self._slot.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def clear(self):
+        for wheel in self._wheels:
+            for slot in wheel:
+                slot.clear()
+        self._slot.clear()
+
+    def advance(self, now=None):
+        """Move the wheel to `now` (default: the clock) and return the keys
+        that came due on the way, in order of expiry.
+        """
+        target = int((self.clock() if now is None else now) / self.resolution)
+        fired = []
+        bits, mask = self._bits, self._mask
+        while self._tick < target:
+            if not self._slot:
+                self._tick = target
+                break
+            t = self._tick = self._tick + 1
+            if not t & mask:
+                # higher level slots that start now, top first, since
+                # their keys may land in a lower slot that also starts now
+                for level in range(self._levels - 1, 0, -1):
+                    shift = bits*level
+                    if t & ((1 << shift) - 1):
+                        continue
+                    slot = self._wheels[level][(t >> shift) & mask]
+                    if slot:
+                        items = list(slot.items())
+                        slot.clear()
+                        for key, expiry in items:
+                            if expiry <= t:
+                                del self._slot[key]
+                                fired.append(key)
+                            else:
+                                self._insert(key, expiry)
+            slot = self._wheels[0][t & mask]
+            if slot:
+                for key in slot:
+                    del self._slot[key]
+                fired.extend(slot)
+                slot.clear()
+        return fired
+
+
+# These will be overwritten if game level loaded in Game.new, or by
+# load_saved_ids()
+unique_item_ids = Unique_id()
+item_id_man = ItemIDManager()
+
+
+def load_saved_ids(path="saveIDs.sav"):
+    """Restore unique_item_ids and item_id_man from a pickle saved by a
+    previous run, if there is one. No longer done at import, so that web
+    workers do not pay for it on boot.
+    """
+    global unique_item_ids, item_id_man
+    import pickle
+    try:
+        fl = open(path, "rb")
+    except OSError:
+        return False
+    with fl:
+        unique_item_ids, item_id_man = pickle.load(fl)
+    return True
 
 # def load_saved_level():
 #     level = None
@@ -0,0 +1,249 @@
+"""The parts of the web servers that do not depend on the framework, shared
+by flask_server and async_server: the rate-limit key, response bodies,
+the bookkeeping around a backend call and the framing of server-sent
+events. The servers keep only the glue to their request and response
+objects, and the way they publish and wait.
+"""
+
+import os
+import time
+from queue_app import utils
+from queue_app import db
+from queue_app import ratelimit
+from queue_app import admission
+from queue_app import jsoncodec
+from queue_app import partitioning
+from queue_app.metrics import metrics
+from queue_app.logger import log
+from queue_app import common
+
+
+def remote_address(forwarded, remote_addr):
+    """The client's own address, as the proxy in front saw it, from the
+    X-Forwarded-For header (or None) and the peer address.
+    """
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return remote_addr or '127.0.0.1'
+
+
+def identity(private_id, path, address):
+    """Rate-limit key: the private id, from the query string or the first
+    part of the path (see id_in_path), or else the client's address, so
+    that requests without an id do not all share one budget.
+    """
+    if private_id is None:
+        private_id = path.lstrip('/').split('/')[0]
+    if utils.is_private_id(private_id):
+        return private_id
+    return address
+
+
+def new_limiter():
+    return ratelimit.from_url(os.environ.get('RATELIMIT_STORAGE_URL',
+                                             common.RATELIMIT_STORAGE_URL),
+                              common.CALLS_PER_SECOND)
+
+
+def rate_limited(wait):
+    """Count a request turned away by the limiter, and return the 429
+    answer as (body, status, headers).
+    """
+    metrics.inc('queue_app_rate_limited_total')
+    return ("Too Many Requests: {} per 1 second".format(common.CALLS_PER_SECOND),
+            429, {"Retry-After": ratelimit.retry_after_header(wait)})
+
+
+def overloaded(limit):
+    """The 503 answer to a call that `limit` turned away, as (body, status,
+    headers).
+    """
+    return ("Service Unavailable: too many requests waiting for the "
+            "game server", 503,
+            {"Retry-After": ratelimit.retry_after_header(limit.retry_after())})
+
+
+def json_body(body, callback=None):
+    """(body, mimetype) for a JSON response, JSONP-wrapped when a callback
+    parameter is given (like flask_jsonpify.jsonify). Bytes or str are
+    passed through without decoding; None means the backend did not reply;
+    anything else is encoded.
+    """
+    if body is None:
+        body = {"ERROR": "No reply from the game server"}
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    elif not isinstance(body, bytes):
+        body = jsoncodec.dumps(body)
+    if callback:
+        return (callback.encode('utf-8') + b"(" + body + b");",
+                'application/javascript')
+    return body, 'application/json'
+
+
+@utils.cached_for(common.STATS_CACHE_TTL)
+def stats_totals_text():
+    totals = db.stats_totals()
+    return "There have been {} games played so far, with a total of {} API calls.".format(totals['games'], totals['game_events'])
+
+
+def new_admission_limit():
+    """One per process: forked workers each get a copy, counting only
+    their own calls; with the event loop, it counts every waiting request
+    of the process.
+    """
+    target = float(os.environ.get('ADMISSION_TARGET') or common.ADMISSION_TARGET)
+    if not target:
+        return None
+    return admission.ConcurrencyLimiter(target,
+                                        max_limit=common.ADMISSION_MAX_LIMIT)
+
+
+def new_router():
+    partitions = partitioning.parse_partitions(os.environ.get('PARTITIONS',
+                                                    common.PARTITIONS))
+    return partitioning.Router(partitions) if partitions else None
+
+
+def publish_batch_window():
+    """Sec to collect commands for one publish, or None to publish each.
+    """
+    window = os.environ.get('PUBLISH_BATCH_WINDOW', common.PUBLISH_BATCH_WINDOW)
+    return float(window) if window else None
+
+
+class BackendCall(object):
+    """One command sent to the backend by do_messaging: its admission (see
+    admission.py), the messages it is published as, and its metrics and
+    sampled log lines. Use as
+
+        call = BackendCall(content, is_admin, limit, router)
+        if not call.admit():
+            ... answer overloaded(call.limit)
+        try:
+            for msg_id, channel, payload in call.prepare(instance, expect,
+                                                         endpoint):
+                ... publish
+            ... wait for each reply (None if it does not come)
+            data = call.replied(replies)
+        finally:
+            call.release()
+
+    A command is one message, except that with partitions a command about
+    no player goes to each of them, and their replies are merged.
+    """
+    def __init__(self, content, is_admin, limit, router=None):
+        self.content = content
+        self.is_admin = is_admin
+        self.router = router
+        self.labels = (('command', next(iter(content))),)
+        # admin calls are never turned away, nor counted
+        self.limit = None if is_admin else limit
+        self.start = None
+        self.sample = False
+        self.instance = None
+        self.partitions = None
+
+    def admit(self):
+        if self.limit is None:
+            return True
+        self.start = self.limit.acquire()
+        if self.start is None:
+            metrics.inc('queue_app_shed_total', self.labels)
+            return False
+        return True
+
+    def prepare(self, instance, expect, endpoint=None):
+        """Fill in the command's reply fields; return (msg_id, channel,
+        encoded command) for each message to publish. expect() gives a new
+        msg_id.
+        """
+        content = self.content
+        self.instance = content['client'] = instance
+        content['_call_time'] = self.t0 = time.time()
+        self.sample = log.sampled(endpoint)
+        if self.router is not None:
+            self.partitions = self.router.partitions_for(content)
+            if len(self.partitions) > 1:
+                messages = []
+                for partition in self.partitions:
+                    content['_msg_id'] = msg_id = expect()
+                    messages.append((msg_id, self.router.channel(content,
+                                        self.is_admin, partition),
+                                     jsoncodec.dumps(content)))
+                if self.sample:
+                    log.info("do_messaging content = %s (to %d partitions)",
+                             content, len(messages))
+                return messages
+            channel = self.router.channel(content, self.is_admin,
+                                          self.partitions[0])
+        elif self.is_admin:
+            channel = 'admin'
+        else:
+            channel = 'player-in'
+        content['_msg_id'] = msg_id = expect()
+        if self.sample:
+            log.info("do_messaging content = %s", content)
+        return [(msg_id, channel, jsoncodec.dumps(content))]
+
+    def replied(self, replies):
+        """The reply to return, from the reply bodies (None for no reply)
+        of the messages prepare() gave, in the same order: None if none
+        came back.
+        """
+        if all(reply is None for reply in replies):
+            metrics.inc('queue_app_reply_timeouts_total', self.labels)
+            log.error("Waited too long for response: t={}".format(self.t0))
+            return None
+        if len(replies) == 1:
+            data = replies[0]
+        else:
+            decoded = []
+            for reply in replies:
+                try:
+                    decoded.append(None if reply is None else jsoncodec.loads(reply))
+                except ValueError:
+                    decoded.append(None)
+            data = partitioning.merge_replies(self.partitions, decoded)
+        metrics.observe('queue_app_reply_seconds', time.time() - self.t0,
+                        self.labels)
+        if self.sample:
+            log.info("Returning a value from client %s: %s", self.instance, data)
+        if self.limit is not None:
+            self.limit.release(self.start, True)
+            self.limit = None
+        return data
+
+    def release(self):
+        """End the call if replied() did not get a reply: a timeout or
+        error.
+        """
+        if self.limit is not None:
+            self.limit.release(self.start, False)
+            self.limit = None
+
+
+# server-sent events for /status/stream
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+SSE_START = b"retry: 3000\n\n"
+SSE_KEEP_ALIVE = b": keep-alive\n\n"
+
+
+def sse_event(body):
+    # compact JSON has no newlines, so one data line suffices
+    return b"data: " + body + b"\n\n"
+
+
+def ends_stream(body):
+    # the entry is gone (or was never there)
+    return b'"ERROR"' in body
+
+
+def renewal_is_event(body, first):
+    """Whether the reply to a watch renewal is sent to the player, rather
+    than a keep-alive comment. No reply (None) or a 503 Response: no, try
+    again at the next renewal. Otherwise only the first status or an
+    error: changes come as pushes, which are in order, and this reply may
+    be newer than a push still queued.
+    """
+    return isinstance(body, bytes) and (first or ends_stream(body))